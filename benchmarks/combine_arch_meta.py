@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+"""
+Benchmark combining many synthetic environments with combine_arch_meta.
+
+Environments are generated for a platform x python matrix (e.g. "osx and arm64 and py==312").
+Most packages have the same version everywhere, and some differ by platform or python version.
+The current combiner is timed for increasing numbers of packages, together with the original
+algorithm (which rescans all environments for every package and version). The outputs of both are
+checked to be equivalent.
+"""
+
+import argparse
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).absolute().parents[1]))
+
+from combine_arch_meta import combine_environments, get_atoms  # noqa: E402
+
+PLATFORMS = ["linux and x86_64", "osx and x86_64", "osx and arm64", "win"]
+PYTHONS = ["py==311", "py==312", "py==313"]
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--packages",
+        default="1000,2000,4000,8000",
+        help="Comma-separated numbers of packages per environment",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    return parser
+
+
+def make_environments(n_packages):
+    labels = [f"{platform} and {python}" for platform in PLATFORMS for python in PYTHONS]
+    environments = {label: {} for label in labels}
+    for i in range(n_packages):
+        name = f"pkg{i}"
+        kind = random.random()
+        for label in labels:
+            if kind < 0.8:
+                version = "1.0"
+            elif kind < 0.9:
+                version = f"1.{PLATFORMS.index(label.rpartition(' and ')[0])}"
+            else:
+                version = f"2.{PYTHONS.index(label.rpartition(' and ')[2])}"
+            environments[label][name] = {"name": name, "version": version}
+    return environments
+
+
+def combine_original(environments):
+    package_names = sorted(set(sum([list(e.keys()) for e in environments.values()], [])))
+    all_packages = []
+    for p in package_names:
+        versions = sorted(
+            {
+                environments[e][p]["version"].strip()
+                for e in environments
+                if p in environments[e]
+            }
+        )
+        for v in versions:
+            platforms = sorted(
+                [
+                    e
+                    for e in environments
+                    if p in environments[e] and environments[e][p]["version"] == v
+                ]
+            )
+            platforms = [] if len(platforms) == len(environments) else platforms
+            all_packages.append({"name": p, "platforms": platforms, "version": v})
+    return all_packages
+
+
+def selects(selector, label):
+    # whether a selector from combine_environments is true for an environment
+    if not selector:
+        return True
+    return any(get_atoms(term) <= get_atoms(label) for term in selector.split(" or "))
+
+
+def main():
+    args = get_parser().parse_args()
+    random.seed(args.seed)
+
+    print(f"{'packages':>8s} {'entries':>8s} {'original (s)':>13s} {'current (s)':>12s}")
+    for n_packages in [int(n) for n in args.packages.split(",")]:
+        environments = make_environments(n_packages)
+        n_entries = sum(len(env) for env in environments.values())
+
+        t0 = time.perf_counter()
+        original = combine_original(environments)
+        t1 = time.perf_counter()
+        current = combine_environments(environments)
+        t2 = time.perf_counter()
+        print(f"{n_packages:8d} {n_entries:8d} {t1 - t0:13.3f} {t2 - t1:12.3f}")
+
+        if not same_requirements(original, current, environments):
+            print("the combined requirements differ from the original ones")
+            sys.exit(1)
+
+
+def same_requirements(original, current, environments):
+    """
+    Check that the requirements select the same packages in each environment.
+    """
+    if len(original) != len(current):
+        return False
+    for old, new in zip(original, current, strict=True):
+        if (old["name"], old["version"]) != (new["name"], new["version"]):
+            return False
+        expected = old["platforms"] or list(environments)
+        selected = [label for label in environments if selects(new["platforms"], label)]
+        if selected != [label for label in environments if label in expected]:
+            return False
+    return True
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+"""
+Benchmark saving and loading patch instruction archives.
+
+This compares the original format (indented JSON in a .tar.bz2 file, extracted to a temporary
+directory to read it) with the zst one (compact JSON in a .tar.zst file, parsed straight from the
+decompressed stream, saved with --compression zst), using synthetic patch instructions for several
+platforms.
+"""
+
+import argparse
+import json
+import random
+import sys
+import tarfile
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).absolute().parents[1]))
+
+from conda_fetch import load_patches, save_patches  # noqa: E402
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--platforms",
+        default="noarch,linux-64,osx-64,osx-arm64,win-64",
+        help="Comma-separated list of platforms",
+    )
+    parser.add_argument(
+        "--packages", type=int, default=20_000, help="Patched packages per platform"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    return parser
+
+
+def make_patches(platforms, n_packages):
+    patches = {}
+    for platform in platforms:
+        patches[platform] = {
+            "patch_instructions_version": 1,
+            "packages": {
+                f"pkg{i}-1.{i % 17}-py_{i % 5}.tar.bz2": {
+                    "depends": [
+                        f"dep{random.randrange(1000)} >=1.{j}" for j in range(random.randrange(8))
+                    ],
+                    "license_family": random.choice(["MIT", "BSD", "GPL"]),
+                }
+                for i in range(n_packages)
+            },
+            "packages.conda": {},
+            "remove": [],
+            "revoke": [],
+        }
+    return patches
+
+
+def save_patches_original(patches, output_dir):
+    with tempfile.TemporaryDirectory() as td:
+        tempdir = Path(td)
+        for platform in patches:
+            (tempdir / platform).mkdir(parents=True, exist_ok=True)
+            with open(tempdir / platform / "patch_instructions.json", "w") as fh:
+                json.dump(patches[platform], fh, indent=2)
+        with tarfile.open(output_dir / "patch_instructions.tar.bz2", "w:bz2") as zf:
+            for file in tempdir.glob("*/*.json"):
+                zf.add(str(file), arcname=file.relative_to(tempdir))
+
+
+def load_patches_original(filename):
+    patches = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        with tarfile.open(filename, "r:bz2") as zf:
+            zf.extractall(tmpdir)
+        for patch_file in Path(tmpdir).glob("*/patch_instructions.json"):
+            with open(patch_file) as fh:
+                patches[patch_file.parent.name] = json.load(fh)
+    return patches
+
+
+def timed(func, *args, **kwargs):
+    t0 = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - t0
+
+
+def main():
+    args = get_parser().parse_args()
+    random.seed(args.seed)
+    patches = make_patches(args.platforms.split(","), args.packages)
+
+    with tempfile.TemporaryDirectory() as td:
+        original_dir = Path(td) / "original"
+        current_dir = Path(td) / "current"
+        original_dir.mkdir()
+
+        _, t_save_original = timed(save_patches_original, patches, original_dir)
+        loaded_original, t_load_original = timed(
+            load_patches_original, original_dir / "patch_instructions.tar.bz2"
+        )
+        _, t_save = timed(save_patches, patches, current_dir, compression="zst")
+        loaded, t_load = timed(load_patches, current_dir)
+        if not loaded == loaded_original == patches:
+            print("loaded patches differ from the saved ones")
+            sys.exit(1)
+
+        size_original = (original_dir / "patch_instructions.tar.bz2").stat().st_size
+        (archive,) = current_dir.glob("patch_instructions.tar.*")
+        print(f"{'':12s} {'save (s)':>9s} {'load (s)':>9s} {'size (MB)':>10s}")
+        print(
+            f"{'original':12s} {t_save_original:9.3f} {t_load_original:9.3f}"
+            f" {size_original / 1e6:10.2f}"
+        )
+        print(
+            f"{archive.name.split('.', 1)[1]:12s} {t_save:9.3f} {t_load:9.3f}"
+            f" {archive.stat().st_size / 1e6:10.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
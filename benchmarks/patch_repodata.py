@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+
+"""
+Benchmark applying patch instructions to a large synthetic repodata index.
+
+This generates repodata with the given number of records (half .tar.bz2 and half .conda), and
+patch instructions that change the dependencies of some packages, revoke some and remove others.
+It then times compiling and applying the instructions and comparing the repodata before and after,
+and checks that all dependencies in the patched repodata can still be resolved.
+"""
+
+import argparse
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).absolute().parents[1]))
+
+from repodata_patch import (  # noqa: E402
+    compile_patch_instructions,
+    diff_repodata,
+    patch_repodata,
+)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--records", type=int, default=100_000)
+    parser.add_argument("--names", type=int, default=5_000)
+    parser.add_argument("--fixes", type=int, default=10_000)
+    parser.add_argument("--revoke", type=int, default=500)
+    parser.add_argument("--remove", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=0)
+    return parser
+
+
+def make_repodata(n_records, n_names):
+    names = [f"pkg{i}" for i in range(n_names)]
+    repodata = {"info": {"subdir": "linux-64"}, "packages": {}, "packages.conda": {}}
+    for i in range(n_records):
+        name = names[i % n_names]
+        version = f"1.{i // n_names}"
+        ext, key = (".conda", "packages.conda") if i % 2 else (".tar.bz2", "packages")
+        repodata[key][f"{name}-{version}-0{ext}"] = {
+            "name": name,
+            "version": version,
+            "build": "0",
+            "build_number": 0,
+            "depends": [f"{dep} >=1.0" for dep in random.sample(names, 5)],
+            "subdir": "linux-64",
+        }
+    return repodata
+
+
+def make_instructions(repodata, n_fixes, n_revoke, n_remove):
+    filenames = list(repodata["packages"]) + list(repodata["packages.conda"])
+    filenames = random.sample(filenames, n_fixes + n_revoke + n_remove)
+    fixes = filenames[:n_fixes]
+    # half of the .conda fixes are listed under "packages", as conda_fetch stores them
+    conda_fixes = [fn for fn in fixes if fn.endswith(".conda")]
+    in_packages = set(conda_fixes[::2])
+    return {
+        "patch_instructions_version": 1,
+        "packages": {
+            fn: {"depends": ["python >=3.10"]}
+            for fn in fixes
+            if fn.endswith(".tar.bz2") or fn in in_packages
+        },
+        "packages.conda": {
+            fn: {"depends": ["python >=3.10"]} for fn in conda_fixes if fn not in in_packages
+        },
+        "revoke": filenames[n_fixes : n_fixes + n_revoke],
+        "remove": filenames[n_fixes + n_revoke :],
+    }
+
+
+def unresolvable(repodata):
+    names = {"python"} | {
+        record["name"]
+        for key in ("packages", "packages.conda")
+        for record in repodata[key].values()
+    }
+    return {
+        dep.split()[0]
+        for key in ("packages", "packages.conda")
+        for record in repodata[key].values()
+        for dep in record["depends"]
+        if dep.split()[0] not in names and dep != "package_has_been_revoked"
+    }
+
+
+def not_patched(repodata, instructions):
+    # fixed packages that do not have the new dependencies
+    fixes = [*instructions["packages"].items(), *instructions["packages.conda"].items()]
+    records = {**repodata["packages"], **repodata["packages.conda"]}
+    return [
+        fn
+        for fn, fix in fixes
+        if fn in records and records[fn]["depends"] != fix["depends"]
+    ]
+
+
+def main():
+    args = get_parser().parse_args()
+    random.seed(args.seed)
+    repodata = make_repodata(args.records, args.names)
+    instructions = make_instructions(repodata, args.fixes, args.revoke, args.remove)
+
+    t0 = time.perf_counter()
+    compiled = compile_patch_instructions(instructions)
+    t1 = time.perf_counter()
+    patched = patch_repodata(repodata, compiled)
+    t2 = time.perf_counter()
+    diff = diff_repodata(repodata, patched)
+    t3 = time.perf_counter()
+
+    print(f"records:  {args.records}")
+    print(f"compile:  {t1 - t0:.3f} s")
+    print(f"patch:    {t2 - t1:.3f} s")
+    print(f"diff:     {t3 - t2:.3f} s")
+    print(f"changed:  {len(diff['changed'])}")
+    print(f"removed:  {len(diff['removed'])}")
+    missing = unresolvable(patched)
+    print(f"unresolvable dependencies: {len(missing)}")
+    not_applied = not_patched(patched, instructions)
+    print(f"fixes not applied: {len(not_applied)}")
+    if missing or not_applied:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,17 +2,22 @@
 """
 Make a combined arch-specific core package list from a set of json files with lists of
 packages in conda environments. The json files can be generated by running `conda list --json`
-within the environment one wants to reproduce.
+(or conda_meta.py) within the environment one wants to reproduce. Environment prefixes can also
+be given instead of json files.
 """
 
 import argparse
+import collections
+import itertools
 import json
 import logging
 import pathlib
 import re
 
 import jinja2
-import yaml
+
+import conda_meta
+from recipe_loader import load_recipe
 
 
 def parser():
@@ -26,14 +31,16 @@ def parser():
     parser_.add_argument(
         "--env",
         action="append",
-        metavar="list.json",
-        help="environment file (produced with `conda list --json`)",
+        metavar="LABEL=list.json",
+        help="environment file (produced with `conda list --json`) or environment prefix. The "
+        "label is the selector for this environment (e.g. 'linux', 'osx and arm64' or "
+        "'win and py==312')",
         default=[],
     )
     parser_.add_argument(
         "--subtract-env",
-        metavar="list.json",
-        help="Exclude packages in given json file",
+        metavar="LABEL=list.json",
+        help="Exclude packages in given json file (or environment prefix)",
         action="append",
         default=[],
     )
@@ -89,16 +96,14 @@ def include_list(env, args):
     # remove ska3 packages if required
     # (this is to remove ska3-flight-latest from ska3-core)
     if args._in is not None:
-        with open(args._in) as fh:
-            meta = yaml.load(fh, Loader=yaml.SafeLoader)
-            include = [pkg for pkg in include if pkg in meta["requirements"]["run"]]
+        meta = load_recipe(args._in)
+        include = [pkg for pkg in include if pkg in meta["requirements"]["run"]]
 
     # remove non-ska3 packages if required
     # (this is to remove non-ska3-flight-latest from ska3-flight)
     if args.not_in is not None:
-        with open(args.not_in) as fh:
-            meta = yaml.load(fh, Loader=yaml.SafeLoader)
-            include = [pkg for pkg in include if pkg not in meta["requirements"]["run"]]
+        meta = load_recipe(args.not_in)
+        include = [pkg for pkg in include if pkg not in meta["requirements"]["run"]]
 
     # add explicit includes
     # (otherwise ska3-flight-latest env minus ska3-flight-latest meta does not include ska3-core)
@@ -115,15 +120,19 @@ def get_environments(envs, args):
     environments = {}
     logging.info(f"Reading environments for {envs}:")
     for env in envs:
-        try:
-            platform, filename = env.split("=")
-        except ValueError as e:
-            logging.info(f" - skipped {env}: ", e)
-            raise
+        # the label can contain "=" (e.g. "py==312=list.json")
+        platform, _, filename = env.rpartition("=")
+        if not platform:
+            logging.info(f" - skipped {env}")
+            raise ValueError(f"Environment must be given as LABEL=FILE: {env}")
         else:
             logging.info(f" + {platform}: {filename}")
-            with open(filename) as fh:
-                environments[platform] = {p["name"]: p for p in json.load(fh)}
+            if conda_meta.is_prefix(filename):
+                packages = conda_meta.read_prefix(filename)
+            else:
+                with open(filename) as fh:
+                    packages = json.load(fh)
+            environments[platform] = {p["name"]: p for p in packages}
 
             # replace occurrences of ska3-*-latest packages by the current version of ska3-*
             ska3_latest = {}
@@ -146,51 +155,178 @@ def get_environments(envs, args):
     return environments
 
 
-def main():
-    args = parser().parse_args()
+# conditions that can not be true at the same time (besides "py==311" and "py==312")
+EXCLUSIVE_ATOMS = [
+    {"linux", "osx", "win"},
+    {"unix", "win"},
+    {"x86_64", "arm64", "aarch64", "ppc64le"},
+]
 
-    environments = get_environments(args.env, args)
-    subtract_environments = get_environments(args.subtract_env, args)
 
-    for platform in environments:
-        remove_keys = []
-        for package in environments[platform]:
-            if (
-                platform in subtract_environments
-                and package in subtract_environments[platform]
-                and subtract_environments[platform][package]["version"]
-                == environments[platform][package]["version"]
-            ):
-                remove_keys.append(package)
-        for package in remove_keys:
-            del environments[platform][package]
-
-    package_names = sorted(
-        set(sum([list(e.keys()) for e in environments.values()], []))
-    )
-    all_packages = []
-    for p in package_names:
-        versions = sorted(
-            set(
-                [
-                    environments[e][p]["version"].strip()
-                    for e in environments
-                    if p in environments[e]
-                ]
+def get_atoms(label):
+    """
+    The conditions in an environment label (e.g. "osx and arm64" -> {"osx", "arm64"}).
+    """
+    return frozenset(atom.strip() for atom in label.split(" and "))
+
+
+def atoms_conflict(atom, other):
+    """
+    Check whether two conditions contradict each other (e.g. "osx" and "win").
+    """
+    if atom == other:
+        return False
+    if atom == f"not {other}" or other == f"not {atom}":
+        return True
+    match = re.fullmatch(r"(\w+)\s*==\s*(\S+)", atom)
+    other_match = re.fullmatch(r"(\w+)\s*==\s*(\S+)", other)
+    if match and other_match:
+        return match.group(1) == other_match.group(1)
+    return any(atom in group and other in group for group in EXCLUSIVE_ATOMS)
+
+
+def is_false(term, label, atoms):
+    """
+    Check whether a conjunction of conditions is known to be false for an environment.
+
+    A condition is false for an environment if it contradicts a condition in the environment's
+    label, or if it is what distinguishes a more specific environment (e.g. "arm64" is false for
+    "osx" if there is also an "osx and arm64" environment). Other conditions not in the label are
+    unknown, so a term made of them is not known to be false.
+
+    Parameters
+    ----------
+    term : frozenset
+        The conditions.
+    label : str
+        Label of the environment.
+    atoms : dict
+        The conditions in the label of each environment.
+    """
+    label_atoms = atoms[label]
+    for atom in term:
+        if any(atoms_conflict(atom, other) for other in label_atoms):
+            return True
+        if atom not in label_atoms and any(
+            label_atoms < other and atom in other for other in atoms.values()
+        ):
+            return True
+    return False
+
+
+def get_selector(platforms, labels):
+    """
+    Get a selector that is true for the given environments and false for all others.
+
+    Each environment label is a selector made of conditions joined by "and" (e.g. "osx and arm64").
+    The selector is a disjunction of conjunctions of these conditions, found greedily: each term is
+    the one that covers most of the remaining environments (and the fewest conditions) and is known
+    to be false for every environment not in the list (see `is_false`). If there is no such term,
+    the selector is the disjunction of the labels themselves.
+
+    Parameters
+    ----------
+    platforms : set
+        Labels of the environments where the selector must be true.
+    labels : list
+        Labels of all environments.
+
+    Returns
+    -------
+    str
+        The selector, or an empty string if it is true for all environments.
+    """
+    if set(platforms) >= set(labels):
+        return ""
+    atoms = {label: get_atoms(label) for label in labels}
+    excluded = [label for label in labels if label not in platforms]
+    uncovered = set(platforms)
+    terms = []
+    while uncovered:
+        candidates = {
+            frozenset(term)
+            for label in uncovered
+            for n in range(1, len(atoms[label]) + 1)
+            for term in itertools.combinations(sorted(atoms[label]), n)
+        }
+        candidates = [
+            term
+            for term in candidates
+            if all(is_false(term, label, atoms) for label in excluded)
+        ]
+        if not candidates:
+            selector = " or ".join(sorted(platforms))
+            unknown = [
+                label
+                for label in excluded
+                if not all(is_false(atoms[p], label, atoms) for p in platforms)
+            ]
+            logging.warning(
+                f"Environment labels are ambiguous: the selector '{selector}' might also be "
+                f"true for {', '.join(unknown)}"
             )
+            return selector
+        term = max(
+            candidates,
+            key=lambda t: (
+                sum(t <= atoms[label] for label in uncovered),
+                -len(t),
+                sorted(t),
+            ),
         )
-        for v in versions:
-            platforms = sorted(
-                [
-                    e
-                    for e in environments
-                    if p in environments[e] and environments[e][p]["version"] == v
-                ]
-            )
-            platforms = [] if len(platforms) == len(environments) else platforms
+        terms.append(" and ".join(sorted(term)))
+        uncovered = {label for label in uncovered if not term <= atoms[label]}
+    return " or ".join(sorted(terms))
+
+
+def combine_environments(environments, subtract_environments=None):
+    """
+    Combine the packages of several environments into a list of requirements with selectors.
+
+    Parameters
+    ----------
+    environments : dict
+        Packages in each environment (as returned by `get_environments`).
+    subtract_environments : dict
+        Packages to exclude from the environment with the same label, if their version matches.
+
+    Returns
+    -------
+    list
+        A list of dictionaries with keys "name", "version" and "platforms" (the selector).
+    """
+    subtract_environments = subtract_environments or {}
+    labels = sorted(environments)
+
+    # name -> version -> set of environments, in a single pass over all packages
+    packages = collections.defaultdict(lambda: collections.defaultdict(set))
+    for label, env in environments.items():
+        subtract = subtract_environments.get(label, {})
+        for name, pkg in env.items():
+            version = pkg["version"].strip()
+            if name in subtract and subtract[name]["version"].strip() == version:
+                continue
+            packages[name][version].add(label)
+
+    selectors = {}
+    all_packages = []
+    for name in sorted(packages):
+        for version in sorted(packages[name]):
+            platforms = frozenset(packages[name][version])
+            if platforms not in selectors:
+                selectors[platforms] = get_selector(platforms, labels)
             all_packages.append(
-                {"name": p, "platforms": " or ".join(platforms), "version": v}
+                {"name": name, "platforms": selectors[platforms], "version": version}
             )
+    return all_packages
+
+
+def main():
+    args = parser().parse_args()
+
+    environments = get_environments(args.env, args)
+    subtract_environments = get_environments(args.subtract_env, args)
+    all_packages = combine_environments(environments, subtract_environments)
 
     tpl = jinja2.Template(YAML_TPL)
     meta = tpl.render(
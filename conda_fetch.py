@@ -11,51 +11,107 @@ merge them. Hopefully this will work... famous last words.
 """
 
 
+import argparse
+import collections
+import contextlib
+import functools
+import hashlib
+import io
+import itertools
 import json
-import os
-import re
 import logging
 import logging.config
+import os
+import pprint
+import re
+import shutil
 import subprocess
-import requests
-import collections
-import argparse
+import sys
 import tarfile
 import tempfile
-import shutil
-import functools
-import pprint
-import tqdm
-import itertools
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-from urllib.parse import urlparse, urlunparse
 
+import requests
+import tqdm
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import conda_meta
+import repodata_cache
+import repodata_patch
 
 logger = logging.getLogger("skare3")
 
 
+DEFAULT_CHANNELS = {
+    "defaults": [
+        "https://repo.anaconda.com/pkgs/main",
+        "https://repo.anaconda.com/pkgs/r",
+    ]
+}
+
+
 def get_conda_list(
-    conda_lists=(), packages=(), subdirs=(), channels=(), override_channels=False
+    conda_lists=(),
+    packages=(),
+    subdirs=(),
+    channels=(),
+    override_channels=False,
+    *,
+    cache_dir=None,
 ):
-    conda_options = []
-    for channel in channels:
-        conda_options += ["-c", channel]
-    if override_channels:
-        conda_options += ["--override-channels"]
+    """
+    Get the list of packages to fetch.
 
+    The list comes from `conda list --json` files or environment prefixes (one per environment),
+    from searching the given package specs in the channels' repodata, or from the packages
+    installed in the current environment. Each package is listed only once per platform (see
+    `dedupe_conda_list`).
+    """
     if conda_lists:
-        return _conda_list_from_files(conda_lists)
+        conda_list = _conda_list_from_files(conda_lists)
     elif packages:
-        return _conda_list_from_search(
-            packages, conda_options=conda_options, subdirs=subdirs
+        conda_list = _conda_list_from_search(
+            packages,
+            channels=channels,
+            override_channels=override_channels,
+            subdirs=subdirs,
+            cache_dir=cache_dir,
         )
     else:
-        return _default_conda_list(" ".join(conda_options))
+        conda_options = []
+        for channel in channels:
+            conda_options += ["-c", channel]
+        if override_channels:
+            conda_options += ["--override-channels"]
+        conda_list = _default_conda_list(" ".join(conda_options))
+    return dedupe_conda_list(conda_list)
+
+
+def dedupe_conda_list(conda_list):
+    """
+    Remove repeated packages from a conda list, keeping the first entry for each package.
+
+    Conda lists from several environments (e.g. one per OS) share all their noarch packages, and
+    searching in several subdirs finds noarch packages once per subdir. Packages are the same if
+    they have the same (platform, dist_name).
+    """
+    result = {}
+    for pkg in conda_list:
+        result.setdefault((pkg["platform"], pkg["dist_name"]), pkg)
+    if len(result) < len(conda_list):
+        logger.debug(f"Removed {len(conda_list) - len(result)} repeated packages")
+    return list(result.values())
 
 
 @functools.cache
 def _default_conda_list(conda_options=None):
     # get list of all installed packages
+    prefix = conda_meta.get_default_prefix()
+    if conda_meta.is_prefix(prefix):
+        return conda_meta.read_prefix(prefix)
     cmd = ["conda", "list", "--json"]
     if conda_options:
         cmd += conda_options.split()
@@ -65,12 +121,16 @@ def _default_conda_list(conda_options=None):
 
 
 def _conda_list_from_files(filenames):
+    # filenames can also be environment prefixes
     missing = []
     conda_list = []
     for filename in filenames:
         if not Path(filename).exists():
             missing.append(filename)
             continue
+        if conda_meta.is_prefix(filename):
+            conda_list += conda_meta.read_prefix(filename)
+            continue
         with open(filename) as fh:
             conda_list += json.load(fh)
     if missing:
@@ -78,54 +138,153 @@ def _conda_list_from_files(filenames):
     return conda_list
 
 
-def _conda_list_from_search(packages, conda_options=None, subdirs=()):
-    conda_list = []
-    cmd = ["conda", "search", "--json"]
-    if conda_options:
-        cmd += conda_options
+@functools.cache
+def _configured_channels():
+    proc = subprocess.run(
+        ["conda", "config", "--show", "channels", "--json"], capture_output=True
+    )
+    if proc.returncode != 0:
+        return ("defaults",)
+    return tuple(json.loads(proc.stdout.decode())["channels"])
 
-    if subdirs:
-        cmds = [cmd + ["--subdir", subdir] for subdir in subdirs]
-    else:
-        cmds = [cmd]
-    for pkg_spec, cmd in tqdm.tqdm(itertools.product(packages, cmds)):
-        proc = subprocess.Popen(cmd + [pkg_spec], stdout=subprocess.PIPE)
-        stdout, _ = proc.communicate()
-        if proc.returncode == 0:
-            result = json.loads(stdout.decode())
-            if len(result) > 1:
-                msg = f"Search for {pkg_spec} yields more than one package:"
-                for name in result:
-                    msg += f"\n  {name}"
-                raise Exception(msg)
-            result = list(result.values())[0]
-            result = [pkg for pkg in result if match(pkg, pkg_spec)]
-            if len(result) > 1:
-                msg = f"Search for {pkg_spec} yields more than one package:"
-                for pkg in result:
-                    msg += f"\n  {pkg['name']}-{pkg['version']}-{pkg['build']} {pkg['channel']}"
-                raise Exception(msg)
-            if result:
-                url = urlparse(result[0]["url"])
-                url = url._replace(
-                    path=url.path.replace(
-                        f"/{result[0]['subdir']}/{result[0]['fn']}", ""
-                    )
-                )
-                conda_list.append(
-                    {
-                        "name": result[0]["name"],
-                        "version": result[0]["version"],
-                        "build": result[0]["build"],
-                        "platform": result[0]["subdir"],
-                        "url": result[0]["url"],
-                        "dist_name": f"{result[0]['name']}-{result[0]['version']}-{result[0]['build']}",
-                        "base_url": urlunparse(url),
-                    }
-                )
+
+def get_channel_urls(channels=(), override_channels=False):
+    """
+    Get the URLs of a list of conda channels.
+
+    Channel names are expanded the same way conda does it ("defaults" is Anaconda's main and r
+    channels, other names are channels in anaconda.org). Unless override_channels is True, the
+    channels from the conda configuration are added after the given ones.
+    """
+    channels = list(channels)
+    if not override_channels:
+        channels += [c for c in _configured_channels() if c not in channels]
+    urls = []
+    for channel in channels:
+        if channel in DEFAULT_CHANNELS:
+            channel_urls = DEFAULT_CHANNELS[channel]
+        elif "://" in channel:
+            channel_urls = [channel.rstrip("/")]
+        else:
+            channel_urls = [f"https://conda.anaconda.org/{channel.strip('/')}"]
+        urls += [url for url in channel_urls if url not in urls]
+    return urls
+
+
+def get_repodata_index(
+    channel_urls, subdirs, session=None, concurrency=8, cache_dir=None
+):
+    """
+    Index all packages in the repodata of the given channels and subdirs.
+
+    The repodata of each (channel, subdir) is fetched only once, and is cached locally (see
+    `repodata_cache`). Packages available in both formats are included only once, as .conda.
+
+    Returns
+    -------
+    dict
+        Keys are package names and values are lists of records with the same keys as the records
+        from `conda search --json` (name, version, build, subdir, fn, url, channel).
+    """
+    if session is None:
+        session = get_session(concurrency)
+    keys = list(itertools.product(channel_urls, subdirs))
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        repodata = executor.map(
+            lambda key: repodata_cache.get_repodata(
+                *key, session=session, cache_dir=cache_dir
+            ),
+            keys,
+        )
+
+    index = collections.defaultdict(dict)
+    for (channel_url, subdir), data in zip(keys, repodata, strict=True):
+        if data is None:
+            logger.debug(f"No repodata at {channel_url}/{subdir}")
+            continue
+        # .tar.bz2 first, so they are overwritten by the .conda version if it exists
+        for pkgs_key in ("packages", "packages.conda"):
+            for fn, upstream in data.get(pkgs_key, {}).items():
+                name = upstream["name"]
+                record = {
+                    "name": name,
+                    "version": upstream["version"],
+                    "build": upstream["build"],
+                    "subdir": upstream.get("subdir", subdir),
+                    "fn": fn,
+                    "url": f"{channel_url}/{subdir}/{fn}",
+                    "channel": channel_url,
+                }
+                key = (channel_url, subdir, record["version"], record["build"])
+                index[name][key] = record
+    return {name: list(records.values()) for name, records in index.items()}
+
+
+def _conda_list_from_search(
+    packages, channels=(), override_channels=False, subdirs=(), cache_dir=None
+):
+    """
+    Find the packages matching each spec in the given subdirs.
+
+    Like `conda search --subdir`, noarch packages are found in all subdirs. If no subdir is given,
+    the current subdir is used.
+    """
+    if not subdirs:
+        from recipe_loader import get_conda_subdir
+
+        subdirs = [get_conda_subdir()]
+    channel_urls = get_channel_urls(channels, override_channels)
+    index = get_repodata_index(
+        channel_urls, set(subdirs) | {"noarch"}, cache_dir=cache_dir
+    )
+
+    conda_list = []
+    for pkg_spec, subdir in itertools.product(packages, subdirs):
+        channel, name, spec = _split_spec(pkg_spec)
+        result = [
+            pkg
+            for pkg in index.get(name, [])
+            if pkg["subdir"] in (subdir, "noarch")
+            and match(pkg, spec)
+            and (not channel or _in_channel(pkg["channel"], channel))
+        ]
+        if len(result) > 1:
+            msg = f"Search for {pkg_spec} yields more than one package:"
+            for pkg in result:
+                msg += f"\n  {pkg['name']}-{pkg['version']}-{pkg['build']} {pkg['channel']}"
+            raise Exception(msg)
+        if result:
+            conda_list.append(
+                {
+                    "name": result[0]["name"],
+                    "version": result[0]["version"],
+                    "build": result[0]["build"],
+                    "platform": result[0]["subdir"],
+                    "url": result[0]["url"],
+                    "dist_name": f"{result[0]['name']}-{result[0]['version']}-{result[0]['build']}",
+                    "base_url": result[0]["channel"],
+                }
+            )
     return conda_list
 
 
+def _split_spec(pkg_spec):
+    # "[channel::]name[=[=]version[=build]]" -> (channel, name, spec without channel)
+    channel, _, spec = pkg_spec.strip().rpartition("::")
+    if not (m := re.match(r"[-_a-zA-Z0-9]+", spec)):
+        raise ValueError(
+            f"Invalid package spec: {pkg_spec!r} (expected [channel::]name[==version[=build]])"
+        )
+    return channel, m.group(0), spec
+
+
+def _in_channel(base_url, channel):
+    # whether a channel URL is the given channel (a name like "conda-forge" or a URL)
+    base_url = base_url.rstrip("/")
+    channel = channel.rstrip("/")
+    return base_url == channel or base_url.endswith(f"/{channel}")
+
+
 def match(package, spec_string):
     """
     Check if a package info matches a spec string.
@@ -160,16 +319,26 @@ def match(package, spec_string):
     return False
 
 
-def get_patch_instructions(packages=(), conda_list=None):
+def get_patch_instructions(
+    packages=(), conda_list=None, concurrency=8, cache_dir=None
+):
     """
     Fetch patch instructions from upstream repositories.
 
+    The patch instructions of all upstream repositories are fetched concurrently, and are cached
+    locally (see `repodata_cache`).
+
     Parameters
     ----------
     packages : list
-        A list of string. A package spec like "cfitsio==4.2.0". It must be a package in the conda list.
+        A list of string. A package spec like "cfitsio==4.2.0". It must be a package in the conda
+        list.
     conda_list : list
         A list of dictionaries. Usually the output of `conda list --json`
+    concurrency : int
+        Maximum number of simultaneous downloads.
+    cache_dir : Path
+        The cache directory (default: repodata_cache.DEFAULT_CACHE_DIR).
 
     Returns
     -------
@@ -178,6 +347,7 @@ def get_patch_instructions(packages=(), conda_list=None):
     """
     if conda_list is None:
         conda_list = get_conda_list()
+    conda_list = dedupe_conda_list(conda_list)
 
     if packages:
         # only consider the ones requested
@@ -192,10 +362,28 @@ def get_patch_instructions(packages=(), conda_list=None):
         conda_list = tmp
 
     # get patch instruction from all upstream repositories
-    urls = set(["{base_url}/{platform}".format(**p) for p in conda_list])
-    rc = {url: requests.get(f"{url}/patch_instructions.json") for url in urls}
+    # upstream patch instructions can be hundreds of MB, so only the entries for the packages in
+    # the conda list are kept
+    filenames = collections.defaultdict(set)
+    for pkg in conda_list:
+        url = "{base_url}/{platform}".format(**pkg)
+        filenames[url] |= {f"{pkg['dist_name']}.tar.bz2", f"{pkg['dist_name']}.conda"}
+    session = get_session(concurrency)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {
+            url: executor.submit(
+                _get_patch_file,
+                f"{url}/patch_instructions.json",
+                filenames[url],
+                session,
+                cache_dir,
+            )
+            for url in sorted(filenames)
+        }
     upstream_patches = {
-        url: json.loads(r.content.decode()) for url, r in rc.items() if r.ok
+        url: future.result()
+        for url, future in futures.items()
+        if future.result() is not None
     }
 
     # put those instructions in our on dictionary
@@ -238,6 +426,125 @@ def get_patch_instructions(packages=(), conda_list=None):
     return patches
 
 
+def _get_patch_file(url, filenames, session, cache_dir):
+    try:
+        filename = repodata_cache.fetch(url, session=session, cache_dir=cache_dir)
+        if filename is not None:
+            return read_patch_instructions(filename, filenames)
+    except Exception as e:
+        logger.warning(f"Could not get {url}: {e}")
+
+
+class _JSONStream:
+    """
+    Minimal incremental reader of a JSON document, for walking large objects one key at a time.
+
+    Only a chunk of the file (plus the value being decoded) is kept in memory.
+    """
+
+    def __init__(self, fh, chunk_size=1 << 20):
+        self.fh = fh
+        self.chunk_size = chunk_size
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self):
+        chunk = self.fh.read(self.chunk_size)
+        self.buf = self.buf[self.pos :] + chunk
+        self.pos = 0
+        self.eof = not chunk
+
+    def _skip_whitespace(self):
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in " \t\n\r":
+                self.pos += 1
+            if self.pos < len(self.buf) or self.eof:
+                return
+            self._fill()
+
+    def peek(self):
+        self._skip_whitespace()
+        return self.buf[self.pos] if self.pos < len(self.buf) else ""
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(f"Expected '{char}' in JSON stream, got '{self.peek()}'")
+        self.pos += 1
+
+    def read_value(self):
+        self._skip_whitespace()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # a value that ends with the buffer might be truncated (e.g. a number)
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill()
+
+    def iter_keys(self):
+        """
+        Iterate over the keys of an object, after its opening brace was consumed.
+
+        The caller must read each key's value before getting the next key.
+        """
+        first = True
+        while self.peek() != "}":
+            if not first:
+                self.expect(",")
+            first = False
+            key = self.read_value()
+            self.expect(":")
+            yield key
+        self.pos += 1
+
+
+def read_patch_instructions(filename, filenames, chunk_size=1 << 20):
+    """
+    Read the patch instructions of some packages from a patch_instructions.json file.
+
+    The file is parsed incrementally, and only the entries for the given package filenames are
+    kept, so memory use does not depend on the size of the file.
+
+    Parameters
+    ----------
+    filename : Path
+        The patch_instructions.json file.
+    filenames : set
+        Package filenames (e.g. "cfitsio-4.2.0-h2c2c8c7_0.tar.bz2").
+    chunk_size : int
+        Number of characters read at a time.
+
+    Returns
+    -------
+    dict
+        The patch instructions restricted to the given packages.
+    """
+    result = {}
+    with open(filename, encoding="utf-8") as fh:
+        stream = _JSONStream(fh, chunk_size=chunk_size)
+        stream.expect("{")
+        for key in stream.iter_keys():
+            if key in ("packages", "packages.conda"):
+                result[key] = {}
+                stream.expect("{")
+                for pkg_filename in stream.iter_keys():
+                    value = stream.read_value()
+                    if pkg_filename in filenames:
+                        result[key][pkg_filename] = value
+            else:
+                value = stream.read_value()
+                if key in ("remove", "revoke"):
+                    value = [item for item in value if item in filenames]
+                result[key] = value
+    return result
+
+
 def _merge_patch_instructions(patch_instructions):
     """
     Merges a list of path instructions.
@@ -283,16 +590,32 @@ def merge_patch_instructions(patch_instructions):
     return patches
 
 
-def get_packages(packages=(), conda_list=None, output_dir=None):
+MANIFEST_FILENAME = "manifest.json"
+
+
+def get_packages(
+    packages=(), conda_list=None, output_dir=None, concurrency=8, cache_dir=None
+):
     """
     Fetch packages from upstream repositories.
 
+    Packages are downloaded concurrently, using a pool of keep-alive connections. Interrupted
+    downloads are resumed the next time.
+
+    Downloaded packages are recorded in a manifest in the output directory (see `load_manifest`).
+    Their size and sha256 are checked against the upstream repodata while downloading, and
+    packages already in the manifest are not fetched again.
+
     Parameters
     ----------
     conda_list : list
         A list of dictionaries. Usually the output of `conda list --json`.
     output_dir : Path
         Directory where to put the packages (each platform in its own subdirectory).
+    concurrency : int
+        Maximum number of simultaneous downloads.
+    cache_dir : Path
+        The cache directory for upstream repodata (default: repodata_cache.DEFAULT_CACHE_DIR).
 
     Returns
     -------
@@ -300,9 +623,10 @@ def get_packages(packages=(), conda_list=None, output_dir=None):
         List of failures
     """
     fail = []
-    base_dir = output_dir if output_dir is not None else Path()
+    base_dir = Path(output_dir) if output_dir is not None else Path()
     if conda_list is None:
         conda_list = get_conda_list()
+    conda_list = dedupe_conda_list(conda_list)
 
     if packages:
         # only consider the ones requested
@@ -317,95 +641,385 @@ def get_packages(packages=(), conda_list=None, output_dir=None):
                 logger.warning(f"Package spec {pkg_string} not found")
         conda_list = tmp
 
-    tmpdir = Path()
-    for pkg in tqdm.tqdm(conda_list):
-        if list((base_dir / pkg["platform"]).glob(f"{pkg['dist_name']}*")):
-            continue
+    manifest = load_manifest(base_dir)
+    conda_list = [pkg for pkg in conda_list if not _in_manifest(pkg, base_dir, manifest)]
+    if not conda_list:
+        return fail
+
+    session = get_session(concurrency)
+    records = get_upstream_records(
+        conda_list, session=session, concurrency=concurrency, cache_dir=cache_dir
+    )
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = {
+                executor.submit(_get_package, session, pkg, base_dir, records): pkg
+                for pkg in conda_list
+            }
+            for future in tqdm.tqdm(as_completed(futures), total=len(futures)):
+                pkg = futures[future]
+                try:
+                    result = future.result()
+                    if result is None:
+                        logger.debug(f"Failed {pkg['dist_name']}")
+                        fail.append(pkg)
+                    else:
+                        key, entry = result
+                        manifest[key] = entry
+                except Exception as e:
+                    logger.warning(f"fail {pkg['dist_name']}: {e}")
+                    fail.append(pkg)
+    finally:
+        save_manifest(base_dir, manifest)
+    return fail
+
+
+def _get_base_url(pkg):
+    return pkg["base_url"].replace(
+        "cxc.cfa.harvard.edu/mta/ASPECT", "icxc.cfa.harvard.edu/aspect"
+    )
+
+
+def _in_manifest(pkg, base_dir, manifest):
+    for ext in (".tar.bz2", ".conda"):
+        key = f"{pkg['platform']}/{pkg['dist_name']}{ext}"
+        if key in manifest:
+            try:
+                if (base_dir / key).stat().st_size == manifest[key]["size"]:
+                    return True
+            except FileNotFoundError:
+                pass
+    return False
+
+
+def _get_package(session, pkg, base_dir, records):
+    base_url = _get_base_url(pkg)
+    upstream = records.get((base_url, pkg["platform"]), {})
+    # the repodata says which formats exist. The .conda format is preferred
+    filenames = [f"{pkg['dist_name']}{ext}" for ext in (".conda", ".tar.bz2")]
+    # if the repodata has no record, the format is guessed, and any HTTP error means trying the
+    # other format
+    guessed = not any(fn in upstream for fn in filenames)
+    filenames = [fn for fn in filenames if fn in upstream] or filenames
+    error = None
+    for filename in filenames:
+        record = upstream.get(filename, {})
+        destination = base_dir / pkg["platform"] / filename
+        if (
+            record.get("sha256")
+            and destination.exists()
+            and file_sha256(destination) == record["sha256"]
+        ):
+            # downloaded before there was a manifest
+            sha256 = record["sha256"]
+        else:
+            url = f"{base_url}/{pkg['platform']}/{filename}"
+            logger.debug(f"Trying {url}")
+            try:
+                sha256 = download(session, url, destination, sha256=record.get("sha256"))
+            except (requests.HTTPError, requests.exceptions.RetryError) as exc:
+                # RetryError means the server kept answering with a 5xx (or 429) status
+                if not guessed:
+                    raise
+                logger.debug(f"Could not get {url}: {exc}")
+                error = exc
+                continue
+            if sha256 is None:
+                continue
+        entry = {
+            "size": destination.stat().st_size,
+            "sha256": sha256,
+            "record": record or None,
+        }
+        return f"{pkg['platform']}/{filename}", entry
+    if error is not None:
+        raise error
+
+
+def get_upstream_records(conda_list, session=None, concurrency=8, cache_dir=None):
+    """
+    Get the upstream repodata records of the packages in a conda list.
+
+    Returns
+    -------
+    dict
+        Keys are (base_url, platform) and values are dictionaries of repodata records keyed by
+        filename. Only the packages in the conda list are included.
+    """
+    filenames = collections.defaultdict(set)
+    for pkg in conda_list:
+        filenames[(_get_base_url(pkg), pkg["platform"])] |= {
+            f"{pkg['dist_name']}.tar.bz2",
+            f"{pkg['dist_name']}.conda",
+        }
+
+    def get_records(key):
         try:
-            pkg["base_url"] = pkg["base_url"].replace(
-                "cxc.cfa.harvard.edu/mta/ASPECT", "icxc.cfa.harvard.edu/aspect"
-            )
-            logger.debug(
-                f"Trying {pkg['base_url']}/{pkg['platform']}/{pkg['dist_name']}.tar.bz2"
-            )
-            proc = subprocess.run(
-                [
-                    "wget",
-                    f"{pkg['base_url']}/{pkg['platform']}/{pkg['dist_name']}.tar.bz2",
-                ],
-                capture_output=True,
+            repodata = repodata_cache.get_repodata(
+                *key, session=session, cache_dir=cache_dir
             )
-            if proc.returncode != 0:
-                logger.debug(
-                    f"Trying {pkg['base_url']}/{pkg['platform']}/{pkg['dist_name']}.conda"
-                )
-                proc = subprocess.run(
-                    [
-                        "wget",
-                        f"{pkg['base_url']}/{pkg['platform']}/{pkg['dist_name']}.conda",
-                    ],
-                    capture_output=True,
-                )
-            if proc.returncode != 0:
-                logger.debug(f"Failed {pkg['dist_name']}")
-                fail.append(pkg)
-            else:
-                platform = base_dir / pkg["platform"]
-                platform.mkdir(exist_ok=True, parents=True)
-                output = list(tmpdir.glob(f"{pkg['dist_name']}*"))
-                if output:
-                    logger.debug(f"Moving {output[0]} -> {platform}")
-                    shutil.move(output[0], platform)
-                else:
-                    raise Exception(
-                        f"Could not find downloaded file '{pkg['dist_name']}*' at {tmpdir}"
-                    )
         except Exception as e:
-            logger.warning(f"fail {pkg['dist_name']}: {e}")
-            fail.append(pkg)
-    return fail
+            logger.warning(f"Could not get repodata for {'/'.join(key)}: {e}")
+            repodata = None
+        if repodata is None:
+            return {}
+        return {
+            fn: record
+            for pkgs_key in ("packages", "packages.conda")
+            for fn, record in repodata.get(pkgs_key, {}).items()
+            if fn in filenames[key]
+        }
 
+    keys = sorted(filenames)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return dict(zip(keys, executor.map(get_records, keys), strict=True))
 
-@functools.cache
-def _with_wget():
-    return subprocess.run(["wget", "--help"], capture_output=True) == 0
 
+def transmute_packages(output_dir, concurrency=8):
+    """
+    Convert the .tar.bz2 packages in the manifest of a directory to .conda.
 
-def wget(url, destination):
-    logger.debug(f"wget {url} -> {destination}")
-    if _with_wget():
-        filename = _wget(url)
-    else:
-        filename = _wget_alt(url)
-    if filename:
-        destination.mkdir(parents=True, exist_ok=True)
-        shutil.move(filename, destination)
-        return filename
+    The .tar.bz2 files are replaced by the .conda files. This requires conda_package_handling.
+
+    Returns
+    -------
+    list
+        The packages (relative paths) that could not be converted.
+    """
+    from conda_package_handling import api as cph_api
+
+    output_dir = Path(output_dir)
+    manifest = load_manifest(output_dir)
+    keys = [
+        key
+        for key in sorted(manifest)
+        if key.endswith(".tar.bz2") and key[: -len(".tar.bz2")] + ".conda" not in manifest
+    ]
+
+    def transmute(key):
+        filename = output_dir / key
+        errors = cph_api.transmute(str(filename), ".conda", out_folder=str(filename.parent))
+        if errors:
+            raise Exception(f"Failed to transmute {key}: {errors}")
+        new_key = key[: -len(".tar.bz2")] + ".conda"
+        new_filename = output_dir / new_key
+        entry = {
+            "size": new_filename.stat().st_size,
+            "sha256": file_sha256(new_filename),
+            "record": None,
+        }
+        if manifest[key]["record"]:
+            entry["record"] = dict(
+                manifest[key]["record"],
+                size=entry["size"],
+                sha256=entry["sha256"],
+                md5=file_md5(new_filename),
+            )
+        return new_key, entry
+
+    fail = []
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {executor.submit(transmute, key): key for key in keys}
+        for future in tqdm.tqdm(as_completed(futures), total=len(futures)):
+            key = futures[future]
+            try:
+                new_key, entry = future.result()
+                manifest[new_key] = entry
+                del manifest[key]
+                (output_dir / key).unlink()
+            except Exception as e:
+                logger.warning(f"fail {key}: {e}")
+                fail.append(key)
+    save_manifest(output_dir, manifest)
+    return fail
+
+
+def file_md5(filename, chunk_size=1 << 20):
+    md5 = hashlib.md5()
+    with open(filename, "rb") as fh:
+        while chunk := fh.read(chunk_size):
+            md5.update(chunk)
+    return md5.hexdigest()
 
 
-def _wget(url):
-    proc = subprocess.run(["wget", url], capture_output=True)
-    if proc.returncode == 0:
-        return Path(url).name
+def file_sha256(filename, chunk_size=1 << 20):
+    sha256 = hashlib.sha256()
+    with open(filename, "rb") as fh:
+        while chunk := fh.read(chunk_size):
+            sha256.update(chunk)
+    return sha256.hexdigest()
 
 
-def _wget_alt(url, destination):
+def load_manifest(output_dir):
     """
-    Wget alternative, in case wget is not present.
+    Load the manifest of the packages in a directory.
+
+    Returns
+    -------
+    dict
+        Keys are package paths relative to the output directory (e.g. "noarch/foo-1.0-0.conda"),
+        and values are dictionaries with keys "size", "sha256" and "record" (the upstream
+        repodata record, if known).
     """
-    r = requests.get(url, stream=True)
-    if r.status_code != 200:
-        return
+    filename = Path(output_dir) / MANIFEST_FILENAME
+    if not filename.exists():
+        return {}
+    with open(filename) as fh:
+        return json.load(fh)["packages"]
 
-    url = Path(url)
-    output_dir = Path(destination)
+
+def save_manifest(output_dir, manifest):
+    output_dir = Path(output_dir)
     output_dir.mkdir(parents=True, exist_ok=True)
-    with open(output_dir / url.name, "wb") as fh:
-        for chunk in r.iter_content(chunk_size=1024):
-            if chunk:
-                fh.write(chunk)
-                fh.flush()
-    return url.name
+    # write and rename, so an interrupted run never leaves a partial manifest
+    fd, tmp_name = tempfile.mkstemp(dir=output_dir, suffix=".tmp")
+    with os.fdopen(fd, "w") as fh:
+        json.dump({"version": 1, "packages": manifest}, fh, sort_keys=True)
+    os.replace(tmp_name, output_dir / MANIFEST_FILENAME)
+
+
+def verify_packages(output_dir, concurrency=8):
+    """
+    Check the size and sha256 of all packages in the manifest of a directory.
+
+    Packages that fail are removed from the manifest, so they are fetched again next time.
+
+    Returns
+    -------
+    list
+        The packages (relative paths) that are missing or corrupt.
+    """
+    output_dir = Path(output_dir)
+    manifest = load_manifest(output_dir)
+
+    def check(key):
+        filename = output_dir / key
+        return (
+            filename.exists()
+            and filename.stat().st_size == manifest[key]["size"]
+            and file_sha256(filename) == manifest[key]["sha256"]
+        )
+
+    keys = sorted(manifest)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        ok = list(tqdm.tqdm(executor.map(check, keys), total=len(keys)))
+    fail = [key for key, key_ok in zip(keys, ok, strict=True) if not key_ok]
+    for key in fail:
+        logger.warning(f"{key} is missing or corrupt")
+        del manifest[key]
+    if fail:
+        save_manifest(output_dir, manifest)
+    return fail
+
+
+def get_session(concurrency=8, retries=5):
+    """
+    A requests session that keeps up to `concurrency` connections alive per host.
+
+    Failed connections and transient server errors are retried with exponential backoff.
+    """
+    retry = Retry(
+        total=retries,
+        backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=("GET", "HEAD"),
+    )
+    adapter = HTTPAdapter(
+        pool_connections=concurrency, pool_maxsize=concurrency, max_retries=retry
+    )
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def _range_start(response):
+    # the first byte of a partial response ("Content-Range: bytes 100-999/1000")
+    match = re.match(r"bytes (\d+)-", response.headers.get("Content-Range", ""))
+    return int(match.group(1)) if match else None
+
+
+def download(session, url, destination, sha256=None, *, retries=5, chunk_size=1 << 20):
+    """
+    Download a file.
+
+    The data is written to a ".part" file, which is renamed to destination when the download is
+    complete. If the ".part" file exists (from an interrupted download) the download resumes from
+    where it stopped, unless the server sends a range that does not start there, in which case it
+    starts over. Connections that break mid-transfer are retried with exponential backoff.
+    The sha256 is computed while downloading.
+
+    Parameters
+    ----------
+    session : requests.Session
+        Session to use (see `get_session`).
+    url : str
+    destination : Path
+    sha256 : str
+        The expected sha256. If given and the downloaded file does not match, it is removed and
+        an exception is raised.
+    retries : int
+        Number of times to resume after a broken connection.
+    chunk_size : int
+
+    Returns
+    -------
+    str
+        The sha256 of the file, or None if the file does not exist upstream.
+    """
+    destination = Path(destination)
+    part = destination.with_name(destination.name + ".part")
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    for attempt in range(retries + 1):
+        offset = part.stat().st_size if part.exists() else 0
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        digest = hashlib.sha256()
+        try:
+            with session.get(url, headers=headers, stream=True, timeout=60) as r:
+                if r.status_code == 416:
+                    # the partial file is already complete
+                    digest = hashlib.sha256(part.read_bytes())
+                    break
+                if r.status_code == 404:
+                    return None
+                r.raise_for_status()
+                if r.status_code == 206 and _range_start(r) != offset:
+                    logger.debug(f"Restarting {url}: got {r.headers.get('Content-Range')}")
+                    part.unlink()
+                    continue
+                # servers that ignore the range header return the whole file
+                mode = "ab" if r.status_code == 206 else "wb"
+                if mode == "ab":
+                    with open(part, "rb") as fh:
+                        while chunk := fh.read(chunk_size):
+                            digest.update(chunk)
+                with open(part, mode) as fh:
+                    for chunk in r.iter_content(chunk_size=chunk_size):
+                        fh.write(chunk)
+                        digest.update(chunk)
+            break
+        except (
+            requests.ConnectionError,
+            requests.Timeout,
+            requests.exceptions.ChunkedEncodingError,
+        ):
+            if attempt == retries:
+                raise
+            logger.debug(f"Retrying {url}")
+            time.sleep(0.5 * 2**attempt)
+    else:
+        raise requests.ConnectionError(f"Could not download {url}")
+    if sha256 is not None and digest.hexdigest() != sha256:
+        part.unlink()
+        raise ValueError(f"sha256 mismatch for {url}")
+    os.replace(part, destination)
+    return digest.hexdigest()
+
+
+PATCH_ARCHIVES = {
+    "zst": "patch_instructions.tar.zst",
+    "bz2": "patch_instructions.tar.bz2",
+}
 
 
 def load_patches(path):
@@ -419,21 +1033,30 @@ def load_patches(path):
     path = Path(path)
     if path.is_dir():
         json_files = list(path.glob("*/patch_instructions.json"))
-        zip_file = path / "patch_instructions.tar.bz2"
-        if json_files and zip_file.exists():
+        zip_files = [
+            path / name for name in PATCH_ARCHIVES.values() if (path / name).exists()
+        ]
+        if json_files and zip_files:
             logger.warning(
                 f"Directory {path} has both json and zipped patch files. Loading from JSON files."
             )
-        if zip_file.exists() and not json_files:
-            return _read_zipped_patch_files(zip_file)
+        if len(zip_files) > 1:
+            zip_files.sort(key=lambda file: file.stat().st_mtime, reverse=True)
+            logger.warning(
+                f"Directory {path} has patch files in several formats. Loading from the newest, "
+                f"{zip_files[0].name}."
+            )
+        if zip_files and not json_files:
+            return _read_zipped_patch_files(zip_files[0])
         else:
             return _read_patch_files(path)
 
-    elif path.name[-8:] == ".tar.bz2":
+    elif path.name.endswith((".tar.bz2", ".tar.zst")):
         return _read_zipped_patch_files(path)
     else:
         raise Exception(
-            f"Cannot read patch instructions: {path} (it must be a directory or a .tar.bz2 file)"
+            f"Cannot read patch instructions: {path} "
+            "(it must be a directory, a .tar.bz2 or a .tar.zst file)"
         )
 
 
@@ -448,15 +1071,54 @@ def _read_patch_files(path):
     return patches
 
 
+@contextlib.contextmanager
+def _open_patch_archive(filename, mode):
+    """
+    Open a patch archive (.tar.bz2 or .tar.zst) as a tar stream, for reading ("r") or writing ("w").
+    """
+    filename = Path(filename)
+    if filename.name.endswith(".tar.bz2"):
+        with tarfile.open(filename, f"{mode}|bz2") as tf:
+            yield tf
+        return
+
+    import zstandard
+
+    with open(filename, f"{mode}b") as fh:
+        if mode == "r":
+            stream = zstandard.ZstdDecompressor().stream_reader(fh)
+        else:
+            # threads=-1 compresses using all CPUs
+            stream = zstandard.ZstdCompressor(level=10, threads=-1).stream_writer(fh)
+        with stream, tarfile.open(fileobj=stream, mode=f"{mode}|") as tf:
+            yield tf
+
+
 def _read_zipped_patch_files(filename):
+    # members are parsed straight from the decompressed stream, without extracting them
     logger.debug(f"Loading patches from {filename}")
-    with tempfile.TemporaryDirectory() as tmpdir:
-        with tarfile.open(filename, "r:bz2") as zf:
-            zf.extractall(tmpdir)
-            return _read_patch_files(Path(tmpdir))
+    patches = {}
+    with _open_patch_archive(filename, "r") as tf:
+        for member in tf:
+            path = Path(member.name)
+            if member.isfile() and path.name == "patch_instructions.json":
+                patches[path.parent.name] = json.load(tf.extractfile(member))
+    return patches
+
 
+def _write_zipped_patch_files(patches, filename, indent=None):
+    with _open_patch_archive(filename, "w") as tf:
+        for platform in sorted(patches):
+            content = json.dumps(patches[platform], indent=indent).encode()
+            info = tarfile.TarInfo(f"{platform}/patch_instructions.json")
+            info.size = len(content)
+            info.mtime = int(time.time())
+            tf.addfile(info, io.BytesIO(content))
 
-def save_patches(patches, output_dir, if_exists=None, zip_patches=True):
+
+def save_patches(
+    patches, output_dir, if_exists=None, zip_patches=True, *, compression=None, indent=None
+):
     """
     Save patch instructions in a directory.
 
@@ -473,14 +1135,21 @@ def save_patches(patches, output_dir, if_exists=None, zip_patches=True):
         - anything else will cause an exception of there are patches in the output directory
     zip_patches : bool
         Whether to store in a compressed file (True) or in JSON files (False).
+    compression : str (optional)
+        Compression of the file: 'bz2' (patch_instructions.tar.bz2, the default) or 'zst'
+        (patch_instructions.tar.zst, which requires zstandard). An archive in the other format is
+        left untouched.
+    indent : int (optional)
+        JSON indentation. The default is 2 for JSON files and no indentation in compressed files.
     """
     output_dir = Path(output_dir)
+    filename = output_dir / PATCH_ARCHIVES[compression or "bz2"]
 
     # these are the files that will be overwritten by this function
     if not zip_patches:
         existing_patch_files = list(output_dir.glob("*/patch_instructions.json"))
     else:
-        existing_patch_files = list(output_dir.glob("patch_instructions.tar.bz2"))
+        existing_patch_files = list(output_dir.glob(filename.name))
 
     existing_patches = {}
     if existing_patch_files:
@@ -489,7 +1158,7 @@ def save_patches(patches, output_dir, if_exists=None, zip_patches=True):
             logger.debug(f"Removing existing patches in {output_dir.absolute()}")
         elif if_exists == "merge":
             logger.debug(f"Merging patches into {output_dir.absolute()}")
-            existing_patches = load_patches(output_dir)
+            existing_patches = load_patches(filename if zip_patches else output_dir)
             patches = merge_patch_instructions([patches, existing_patches])
         else:
             msg = f"Patch instructions already exist at {output_dir.absolute()}: "
@@ -497,6 +1166,11 @@ def save_patches(patches, output_dir, if_exists=None, zip_patches=True):
             raise Exception(msg)
 
     logger.debug(f"Saving patches in {output_dir}")
+    output_dir.mkdir(parents=True, exist_ok=True)
+    if zip_patches:
+        _write_zipped_patch_files(patches, filename, indent=indent)
+        return
+
     # save in a temporary directory
     with tempfile.TemporaryDirectory() as td:
         tempdir = Path(td)
@@ -505,26 +1179,121 @@ def save_patches(patches, output_dir, if_exists=None, zip_patches=True):
             # save in tmpdir
             (tempdir / platform).mkdir(parents=True, exist_ok=True)
             with open(tempdir / platform / "patch_instructions.json", "w") as fh:
-                json.dump(patches[platform], fh, indent=2)
+                json.dump(patches[platform], fh, indent=2 if indent is None else indent)
 
-        output_dir.mkdir(parents=True, exist_ok=True)
-        if zip_patches:
-            with tarfile.open(output_dir / "patch_instructions.tar.bz2", "w:bz2") as zf:
-                for file in tempdir.glob("*/*.json"):
-                    zf.add(str(file), arcname=file.relative_to(tempdir))
-        else:
-            for file in existing_patch_files:
-                logger.debug(f"rm {file}")
-                os.unlink(file)
-            for platform in patches:
-                logger.debug(
-                    f"mv {platform}/patch_instructions.json -> {output_dir / platform}"
-                )
-                (output_dir / platform).mkdir(parents=True, exist_ok=True)
-                shutil.move(
-                    tempdir / platform / "patch_instructions.json",
-                    output_dir / platform / "patch_instructions.json",
-                )
+        for file in existing_patch_files:
+            logger.debug(f"rm {file}")
+            os.unlink(file)
+        for platform in patches:
+            logger.debug(
+                f"mv {platform}/patch_instructions.json -> {output_dir / platform}"
+            )
+            (output_dir / platform).mkdir(parents=True, exist_ok=True)
+            shutil.move(
+                tempdir / platform / "patch_instructions.json",
+                output_dir / platform / "patch_instructions.json",
+            )
+
+
+def read_index_json(filename):
+    """
+    Read info/index.json from a conda package (.tar.bz2 or .conda).
+    """
+    filename = Path(filename)
+    if filename.name.endswith(".tar.bz2"):
+        with tarfile.open(filename, "r:bz2") as tf:
+            return json.load(tf.extractfile("info/index.json"))
+
+    import zipfile
+
+    import zstandard
+
+    with zipfile.ZipFile(filename) as zf:
+        info = [name for name in zf.namelist() if name.startswith("info-")][0]
+        with zf.open(info) as fh:
+            reader = zstandard.ZstdDecompressor().stream_reader(fh)
+            with tarfile.open(fileobj=reader, mode="r|") as tf:
+                for member in tf:
+                    if member.name == "info/index.json":
+                        return json.load(tf.extractfile(member))
+    raise Exception(f"info/index.json not found in {filename}")
+
+
+def make_channel(output_dir, concurrency=8):
+    """
+    Index the packages in a directory as a conda channel.
+
+    This writes repodata.json (and repodata.json.zst if zstandard is installed) in each subdir,
+    with the patch instructions in the directory applied.
+
+    The records of fetched packages are taken from the manifest (they are the upstream repodata
+    records), so only packages that are not in the manifest yet are read and hashed. These are
+    then added to the manifest.
+
+    Parameters
+    ----------
+    output_dir : Path
+        Directory with packages (each platform in its own subdirectory).
+    concurrency : int
+        Maximum number of packages indexed at the same time.
+    """
+    output_dir = Path(output_dir)
+    manifest = load_manifest(output_dir)
+    subdirs = {"noarch"} | {
+        path.name
+        for path in output_dir.iterdir()
+        if path.is_dir() and re.match(r"(noarch|[a-z]+-[a-z0-9]+)$", path.name)
+    }
+    filenames = {
+        f"{subdir}/{path.name}"
+        for subdir in subdirs
+        if (output_dir / subdir).exists()
+        for path in (output_dir / subdir).iterdir()
+        if path.name.endswith((".tar.bz2", ".conda"))
+    }
+
+    def index(key):
+        filename = output_dir / key
+        record = read_index_json(filename)
+        record.update(
+            size=filename.stat().st_size,
+            md5=file_md5(filename),
+            sha256=file_sha256(filename),
+        )
+        return {"size": record["size"], "sha256": record["sha256"], "record": record}
+
+    new_keys = sorted(key for key in filenames if not (manifest.get(key) or {}).get("record"))
+    if new_keys:
+        logger.info(f"Indexing {len(new_keys)} new packages")
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for key, entry in zip(new_keys, executor.map(index, new_keys), strict=True):
+                manifest[key] = entry
+        save_manifest(output_dir, manifest)
+
+    patches = load_patches(output_dir)
+    for subdir in sorted(subdirs):
+        repodata = {
+            "info": {"subdir": subdir},
+            "packages": {},
+            "packages.conda": {},
+            "removed": [],
+            "repodata_version": 1,
+        }
+        for key in sorted(filenames):
+            key_subdir, fn = key.split("/")
+            if key_subdir == subdir:
+                pkgs_key = "packages.conda" if fn.endswith(".conda") else "packages"
+                repodata[pkgs_key][fn] = manifest[key]["record"]
+        repodata = repodata_patch.patch_repodata(repodata, patches.get(subdir, {}))
+
+        logger.debug(f"Writing {subdir}/repodata.json")
+        (output_dir / subdir).mkdir(exist_ok=True)
+        content = json.dumps(repodata, indent=2, sort_keys=True).encode()
+        (output_dir / subdir / "repodata.json").write_bytes(content)
+        if repodata_cache.zstandard is not None:
+            (output_dir / subdir / "repodata.json.zst").write_bytes(
+                repodata_cache.zstandard.ZstdCompressor(level=16).compress(content)
+            )
 
 
 def configure_logging():
@@ -577,12 +1346,23 @@ def get_parser():
         type=Path,
         action="append",
         default=[],
-        help="File(s) with the output of `conda list --json`, one for each environment.",
+        help="File(s) with the output of `conda list --json`, or environment prefixes, "
+        "one for each environment.",
     )
     parser.add_argument("--zip", action="store_true", default=True, help="Zip patches")
     parser.add_argument(
         "--no-zip", action="store_false", dest="zip", help="Do not zip patches"
     )
+    parser.add_argument(
+        "--compression",
+        choices=list(PATCH_ARCHIVES),
+        help="Compression of zipped patches (default=bz2)",
+    )
+    parser.add_argument(
+        "--indent",
+        type=int,
+        help="JSON indentation of patches (default=2 for JSON files, none in zipped patches)",
+    )
     parser.add_argument(
         "--no-patches",
         dest="get_patches",
@@ -625,6 +1405,37 @@ def get_parser():
         default=False,
         help="Override default conda channels",
     )
+    parser.add_argument(
+        "--concurrency",
+        "-j",
+        type=int,
+        default=8,
+        help="Maximum number of simultaneous downloads (default=8)",
+    )
+    parser.add_argument(
+        "--transmute",
+        action="store_true",
+        help="Convert fetched .tar.bz2 packages to .conda (requires conda_package_handling).",
+    )
+    parser.add_argument(
+        "--make-channel",
+        action="store_true",
+        help="Index the output directory as a conda channel (with patches applied).",
+    )
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="Do not get anything, just verify the packages in the output directory.",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=Path,
+        default=repodata_cache.DEFAULT_CACHE_DIR,
+        help=(
+            "Directory where to cache channel metadata "
+            f"(default={repodata_cache.DEFAULT_CACHE_DIR})"
+        ),
+    )
     return parser
 
 
@@ -639,28 +1450,60 @@ def main():
     for line in pprint.pformat(vars(args)).split("\n"):
         logger.info(line)
 
-    if args.merge_patches:
+    if args.verify:
+        fail = verify_packages(args.out, concurrency=args.concurrency)
+        if fail:
+            logger.error(f"{len(fail)} packages are missing or corrupt")
+            sys.exit(1)
+    elif args.merge_patches:
         items = [load_patches(item) for item in args.items]
         patches = merge_patch_instructions(items)
         save_patches(
-            patches, args.out, if_exists=args.if_patches_exist, zip_patches=args.zip
+            patches,
+            args.out,
+            if_exists=args.if_patches_exist,
+            zip_patches=args.zip,
+            compression=args.compression,
+            indent=args.indent,
         )
     else:
-        conda_list = get_conda_list(
-            packages=args.items,
-            conda_lists=args.conda_list,
-            channels=args.channel,
-            override_channels=args.override_channels,
-            subdirs=args.subdir,
-        )
+        if args.get_patches or args.get_packages:
+            conda_list = get_conda_list(
+                packages=args.items,
+                conda_lists=args.conda_list,
+                channels=args.channel,
+                override_channels=args.override_channels,
+                subdirs=args.subdir,
+                cache_dir=args.cache_dir,
+            )
 
         if args.get_patches:
-            patches = get_patch_instructions(args.items, conda_list=conda_list)
+            patches = get_patch_instructions(
+                args.items,
+                conda_list=conda_list,
+                concurrency=args.concurrency,
+                cache_dir=args.cache_dir,
+            )
             save_patches(
-                patches, args.out, if_exists=args.if_patches_exist, zip_patches=args.zip
+                patches,
+                args.out,
+                if_exists=args.if_patches_exist,
+                zip_patches=args.zip,
+                compression=args.compression,
+                indent=args.indent,
             )
         if args.get_packages:
-            get_packages(args.items, conda_list=conda_list, output_dir=args.out)
+            get_packages(
+                args.items,
+                conda_list=conda_list,
+                output_dir=args.out,
+                concurrency=args.concurrency,
+                cache_dir=args.cache_dir,
+            )
+        if args.transmute:
+            transmute_packages(args.out, concurrency=args.concurrency)
+        if args.make_channel:
+            make_channel(args.out, concurrency=args.concurrency)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+
+"""
+Read the list of packages in a conda environment without running conda.
+
+Conda keeps one JSON file per installed package in `<prefix>/conda-meta`. Reading these files
+directly gives the same records as `conda list --no-pip --json` in a fraction of the time, since
+conda itself does not need to be imported.
+"""
+
+import argparse
+import json
+import os
+import re
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from urllib.parse import urlparse
+
+# channels whose canonical name is the URL path (e.g. "conda-forge" or "pkgs/main")
+CHANNEL_ALIASES = (
+    "https://conda.anaconda.org/",
+    "https://repo.anaconda.com/",
+)
+
+
+def get_base_url(url):
+    """
+    The channel URL of a package or subdir URL, without credentials or tokens.
+    """
+    url = urlparse(url)
+    if url.username or url.password:
+        url = url._replace(netloc=url.hostname + (f":{url.port}" if url.port else ""))
+    url = url._replace(path=re.sub(r"^/t/[^/]+", "", url.path))
+    return url.geturl()
+
+
+def get_channel_name(base_url):
+    """
+    The channel name conda would show for a channel URL (e.g. "conda-forge" or "pkgs/main").
+    """
+    for alias in CHANNEL_ALIASES:
+        if base_url.startswith(alias):
+            return base_url[len(alias) :]
+    return base_url
+
+
+def get_custom_channels(channels):
+    """
+    Conda's custom_channels setting (name -> location) for the URL channels in a list.
+
+    Conda does not keep the location of URL channels in package specs (in "https://host/path::pkg"
+    the channel becomes "path" on anaconda.org), but with this setting a package can be pinned to a
+    URL channel by name (e.g. "flight::quaternion").
+    """
+    custom_channels = {}
+    for channel in channels:
+        if "://" not in channel or channel.startswith(CHANNEL_ALIASES):
+            continue
+        location, _, name = channel.rstrip("/").rpartition("/")
+        custom_channels[name] = location
+    return custom_channels
+
+
+def _read_record(filename):
+    with open(filename) as fh:
+        meta = json.load(fh)
+    subdir = meta.get("subdir", "")
+    if meta.get("url"):
+        base_url = get_base_url(meta["url"].rsplit("/", 2)[0])
+    elif meta.get("channel"):
+        base_url = get_base_url(meta["channel"]).removesuffix(f"/{subdir}")
+    else:
+        base_url = ""
+    return {
+        "base_url": base_url,
+        "build_number": meta.get("build_number", 0),
+        "build_string": meta["build"],
+        "channel": get_channel_name(base_url) if base_url else "<unknown>",
+        "dist_name": f"{meta['name']}-{meta['version']}-{meta['build']}",
+        "name": meta["name"],
+        "platform": subdir,
+        "version": meta["version"],
+        # conda_fetch's matching uses "build"
+        "build": meta["build"],
+    }
+
+
+def read_prefix(prefix, max_workers=8):
+    """
+    Get the packages installed in a conda environment.
+
+    Parameters
+    ----------
+    prefix : str or Path
+        The environment's prefix (the directory containing conda-meta).
+    max_workers : int
+        Number of files read at the same time.
+
+    Returns
+    -------
+    list
+        Records with the same keys as `conda list --json` (name, version, build_string,
+        build_number, channel, platform, base_url, dist_name), plus "build", sorted by name.
+    """
+    meta_dir = Path(prefix) / "conda-meta"
+    if not meta_dir.is_dir():
+        raise FileNotFoundError(f"{prefix} is not a conda environment (no conda-meta)")
+    filenames = [entry.path for entry in os.scandir(meta_dir) if entry.name.endswith(".json")]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        records = list(executor.map(_read_record, filenames))
+    return sorted(records, key=lambda record: record["name"])
+
+
+def is_prefix(path):
+    """
+    Whether a path is a conda environment.
+    """
+    return (Path(path) / "conda-meta").is_dir()
+
+
+def get_default_prefix():
+    """
+    The prefix of the active conda environment (or of this python, if none is active).
+    """
+    return os.environ.get("CONDA_PREFIX", sys.prefix)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "prefix",
+        nargs="?",
+        default=get_default_prefix(),
+        help="Environment prefix (default: the active environment)",
+    )
+    args = parser.parse_args()
+    json.dump(read_prefix(args.prefix), sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+
+"""
+Resolve the ska3-core-latest and ska3-flight-latest environments for several platforms at once.
+
+Instead of installing the environments on a machine of each platform, this runs a dry-run solve
+for every target subdir from a single host, with CONDA_SUBDIR set to the target and the virtual
+packages of the target platform (__osx, __glibc, ...) given through CONDA_OVERRIDE_* variables.
+All subdirs are solved concurrently, and conda's repodata cache is shared between solves.
+
+The output has one JSON file per environment and subdir (e.g. ska3-flight-osx-arm64.json), with
+the same records as `conda list --json`, so it can be given directly to combine_arch_meta.py.
+"""
+
+import argparse
+import importlib.util
+import json
+import logging
+import os
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import conda_meta
+import install_specs
+
+PKG_DEFS_PATH = Path(__file__).absolute().parent / "pkg_defs"
+
+ENVIRONMENTS = ["ska3-core", "ska3-flight"]
+
+DEFAULT_SUBDIRS = ["linux-64", "osx-64", "osx-arm64", "win-64"]
+
+# virtual packages of the target platforms. These are only used when solving, so they should be
+# the oldest versions we support.
+VIRTUAL_PACKAGES = {
+    "linux": {"CONDA_OVERRIDE_LINUX": "5.15", "CONDA_OVERRIDE_GLIBC": "2.28"},
+    "osx-64": {"CONDA_OVERRIDE_OSX": "10.15"},
+    "osx-arm64": {"CONDA_OVERRIDE_OSX": "11.0"},
+    "win": {},
+}
+
+
+class SkaException(Exception):
+    pass
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--subdir",
+        action="append",
+        default=[],
+        help=f"Target subdir (can be repeated). Default: {', '.join(DEFAULT_SUBDIRS)}",
+    )
+    parser.add_argument(
+        "--env",
+        action="append",
+        default=[],
+        choices=ENVIRONMENTS,
+        help="Environment to resolve (can be repeated). Default: all",
+    )
+    parser.add_argument(
+        "--ska-channel",
+        action="append",
+        default=[],
+        help="Ska conda channel (e.g. flight, test). Requires CONDA_PASSWORD to be defined",
+    )
+    parser.add_argument(
+        "--conda-channel",
+        action="append",
+        default=[],
+        help="Other conda channels. Default: conda-forge",
+    )
+    parser.add_argument(
+        "-o",
+        "--output-dir",
+        type=Path,
+        default=Path("."),
+        help="Directory where to write the JSON files",
+    )
+    parser.add_argument(
+        "-j",
+        "--concurrency",
+        type=int,
+        default=4,
+        help="Number of solves to run at the same time",
+    )
+    parser.add_argument(
+        "--use-index-cache",
+        action="store_true",
+        help="Use the cached repodata even if it has expired (conda's -C option)",
+    )
+    parser.add_argument(
+        "--conda",
+        default=os.environ.get("CONDA_EXE", "conda"),
+        help="The conda executable (default: $CONDA_EXE or conda)",
+    )
+    return parser
+
+
+def load_installer(name):
+    """
+    Import pkg_defs/<name>-latest/install_from_scratch.py as a module.
+    """
+    filename = PKG_DEFS_PATH / f"{name}-latest" / "install_from_scratch.py"
+    spec = importlib.util.spec_from_file_location(
+        f"{name.replace('-', '_')}_install_from_scratch", filename
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def get_virtual_packages(subdir):
+    """
+    The CONDA_OVERRIDE_* variables to make conda solve as if it were running on subdir.
+    """
+    platform = subdir.split("-")[0]
+    env = {"CONDA_OVERRIDE_CUDA": ""}
+    env.update(VIRTUAL_PACKAGES.get(subdir, VIRTUAL_PACKAGES.get(platform, {})))
+    return env
+
+
+def get_specs(installers, subdir):
+    """
+    The channels and specs of an environment made by running several installers in sequence.
+    """
+    channels, specs = [], []
+    for installer in installers:
+        installer_channels, installer_specs = installer.get_specs(subdir)
+        channels += [c for c in installer_channels if c not in channels]
+        specs += [s for s in installer_specs if s not in specs]
+    return channels, install_specs.merge_pinned_specs(specs)
+
+
+def solve(specs, channels, subdir, conda="conda", use_index_cache=False):
+    """
+    Solve an environment for a given subdir without creating it.
+
+    Returns
+    -------
+    list
+        The packages in the environment, with the same keys as `conda list --json`.
+    """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cmd = [
+            conda,
+            "create",
+            "--dry-run",
+            "--json",
+            "--yes",
+            "--prefix",
+            str(Path(tmpdir) / "env"),
+            "--override-channels",
+        ]
+        cmd += sum([["-c", c] for c in channels], [])
+        if use_index_cache:
+            cmd.append("--use-index-cache")
+        env = dict(os.environ)
+        env.update(get_virtual_packages(subdir))
+        env["CONDA_SUBDIR"] = subdir
+        # URL channels are given names, so specs can be pinned to them
+        with install_specs.custom_channels_condarc(channels) as condarc:
+            env["CONDARC"] = condarc
+            p = subprocess.run(
+                cmd + specs, capture_output=True, text=True, env=env, check=False
+            )
+
+    try:
+        result = json.loads(p.stdout)
+    except json.JSONDecodeError:
+        raise SkaException(
+            f"Failed to solve for {subdir}: {p.stderr.strip() or p.stdout.strip()}"
+        ) from None
+    if p.returncode != 0 or not result.get("success", False):
+        raise SkaException(
+            f"Failed to solve for {subdir}: {result.get('message', result.get('error'))}"
+        )
+
+    records = []
+    for record in result.get("actions", {}).get("LINK", []):
+        base_url = conda_meta.get_base_url(record["base_url"])
+        records.append(
+            {
+                "base_url": base_url,
+                "build_number": record["build_number"],
+                "build_string": record["build_string"],
+                "channel": conda_meta.get_channel_name(base_url),
+                "dist_name": record["dist_name"],
+                "name": record["name"],
+                "platform": record["platform"],
+                "version": record["version"],
+                "build": record["build_string"],
+            }
+        )
+    return sorted(records, key=lambda record: record["name"])
+
+
+def main():
+    args = get_parser().parse_args()
+    logging.basicConfig(level="INFO", format="%(message)s")
+
+    if args.ska_channel and "CONDA_PASSWORD" not in os.environ:
+        raise SkaException("CONDA_PASSWORD environmental variable is not defined")
+
+    subdirs = args.subdir or DEFAULT_SUBDIRS
+    environments = [env for env in ENVIRONMENTS if env in args.env] or ENVIRONMENTS
+
+    # each environment is installed on top of the previous ones (ska3-flight on ska3-core)
+    installers = {}
+    for name in ENVIRONMENTS:
+        installers[name] = load_installer(name)
+        installers[name].set_channels(args.conda_channel, args.ska_channel)
+
+    jobs = {}
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for name in environments:
+            stack = [installers[n] for n in ENVIRONMENTS[: ENVIRONMENTS.index(name) + 1]]
+            for subdir in subdirs:
+                channels, specs = get_specs(stack, subdir)
+                logging.info(f"Solving {name} for {subdir} ({len(specs)} specs)")
+                jobs[(name, subdir)] = executor.submit(
+                    solve,
+                    specs,
+                    channels,
+                    subdir,
+                    conda=args.conda,
+                    use_index_cache=args.use_index_cache,
+                )
+
+    args.output_dir.mkdir(parents=True, exist_ok=True)
+    failed = []
+    for (name, subdir), job in jobs.items():
+        try:
+            records = job.result()
+        except SkaException as exc:
+            logging.error(str(exc))
+            failed.append(f"{name}-{subdir}")
+            continue
+        filename = args.output_dir / f"{name}-{subdir}.json"
+        logging.info(f"{filename}: {len(records)} packages")
+        with open(filename, "w") as fh:
+            json.dump(records, fh, indent=2)
+
+    if failed:
+        raise SkaException(f"Failed to resolve {', '.join(failed)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -30,6 +30,11 @@ def get_parser():
         help="The conda channel(s) to use when installing the dependencies.",
         default=[]
     )
+    parser.add_argument(
+        "--single-solve",
+        action="store_true",
+        help="Install the environment files together with the dependencies, in a single solve.",
+    )
     return parser
 
 
@@ -53,14 +58,17 @@ def main():
     except Exception:
         executable = "conda"
 
-    for env in sorted(srcdir.glob("*environment*.yml")):
-        logging.info(f"Updating environment using {env}")
-        subprocess.run([executable, "env", "update", "-f", env], check=True)
-
     cmd = [
         str(pathlib.Path(__file__).parent.absolute() / "install_yaml_requirements.py"),
         str(srcdir / "meta.yaml"),
     ]
+    for env in sorted(srcdir.glob("*environment*.yml")):
+        if args.single_solve:
+            cmd += ["-e", str(env)]
+            continue
+        logging.info(f"Updating environment using {env}")
+        subprocess.run([executable, "env", "update", "-f", env], check=True)
+
     for ch in args.channel:
         cmd += ["-c", ch]
     logging.info(" ".join(cmd))
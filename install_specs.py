@@ -0,0 +1,174 @@
+"""
+Single list of the specs installed by the pkg_defs/*-latest/install_from_scratch.py scripts.
+
+These scripts install packages in several steps: any environment files in their directory, a list
+of pre-packages, and the requirements in meta.yaml. The functions here merge all of them, so the
+environment can be installed in a single solve (install_from_scratch.py --single-solve) or
+resolved for other platforms (conda_resolve.py).
+"""
+
+import contextlib
+import json
+import logging
+import os
+import pathlib
+import re
+import tempfile
+
+import conda_meta
+from recipe_loader import get_environment_specs
+
+
+def get_specs(pkg_dir, package_list, channels, requirements, subdir):
+    """
+    All packages installed by an installer, in a single list of specs.
+
+    Pre-packages that must come from specific channels are qualified with the channel (see
+    `qualify_specs`).
+
+    Parameters
+    ----------
+    pkg_dir : Path
+        The installer's directory. Environment files in it ("*environment*.yml") are included.
+    package_list : list
+        The pre-packages, as returned by the installer's get_package_list().
+    channels : list
+        The channels used by the installer.
+    requirements : list
+        The meta.yaml requirements.
+    subdir : str
+        The target conda subdir (used for selectors and for pre-packages with a "platform" key).
+
+    Returns
+    -------
+    tuple
+        (channels, specs)
+    """
+    all_channels = list(channels)
+    specs = []
+    for env_file in sorted(pathlib.Path(pkg_dir).glob("*environment*.yml")):
+        env_channels, env_specs = get_environment_specs(env_file, subdir=subdir)
+        all_channels += [c for c in env_channels if c not in all_channels]
+        specs += env_specs
+    for pkgs in package_list:
+        if "platform" in pkgs and subdir not in pkgs["platform"]:
+            continue
+        specs += qualify_specs(pkgs["packages"], pkgs["channels"], channels)
+        specs += pkgs.get("pins", {}).get(subdir, [])
+    specs += requirements
+    return all_channels, merge_pinned_specs(list(dict.fromkeys(specs)))
+
+
+def split_spec(spec):
+    """
+    Split a spec into (channel, name, constraint).
+
+    For example, "flight::foo >= 1" -> ("flight", "foo", ">=1").
+    """
+    channel, _, spec = spec.strip().rpartition("::")
+    match = re.match(r"[^\s=<>!~]+", spec)
+    if not match:
+        raise ValueError(f"Invalid package spec: {spec!r}")
+    constraint = re.sub(r"([=<>!~]+)\s+", r"\1", spec[match.end() :].strip())
+    return channel, match.group(0), constraint
+
+
+def merge_pinned_specs(specs):
+    """
+    Merge the specs of packages pinned to a channel into a single spec per package.
+
+    Specs for the same package with and without a channel can make the solve fail, so the specs
+    of a package that is pinned to a channel somewhere are merged into one channel-qualified spec,
+    where the version constraints are combined (e.g. "flight::foo" and "foo >=1" become
+    "flight::foo >=1"). Constraints that also give a build string are kept as separate specs
+    qualified with the same channel.
+    """
+    pinned = {}
+    for spec in specs:
+        channel, name, _ = split_spec(spec)
+        if channel:
+            pinned.setdefault(name, channel)
+
+    merged = []
+    constraints = {name: [] for name in pinned}
+    for spec in specs:
+        channel, name, constraint = split_spec(spec)
+        if name not in pinned:
+            merged.append(spec)
+            continue
+        if " " in constraint:
+            # version and build
+            merged.append(f"{pinned[name]}::{name} {constraint}")
+        elif constraint and constraint not in constraints[name]:
+            constraints[name].append(constraint)
+    for name, channel in pinned.items():
+        constraint = ",".join(constraints[name])
+        merged.append(f"{channel}::{name} {constraint}".strip())
+    return merged
+
+
+def qualify_specs(specs, pkgs_channels, channels):
+    """
+    Pin specs to a channel if they are installed from channels other than the installer's.
+
+    A spec can only be pinned to one channel, so packages restricted to several other channels
+    are pinned to the first of them, where the sequential install would take them from any.
+    URL channels are pinned by name, which requires them to be in conda's custom_channels (see
+    `custom_channels_condarc`).
+    """
+    if not pkgs_channels or pkgs_channels == channels:
+        return specs
+    if len(pkgs_channels) > 1:
+        logging.warning(
+            f"{', '.join(specs)} can only come from the first of {len(pkgs_channels)} channels"
+        )
+    channel = pkgs_channels[0].rstrip("/").rpartition("/")[2]
+    return [f"{channel}::{spec}" for spec in specs]
+
+
+@contextlib.contextmanager
+def custom_channels_condarc(channels):
+    """
+    A temporary condarc file that names the URL channels, to use as CONDARC.
+
+    The file sets conda's custom_channels (see `conda_meta.get_custom_channels`), so specs can be
+    pinned to URL channels by name. The URLs can include credentials, so the file is only readable
+    by the user and it is removed at the end of the with block.
+
+    Yields
+    ------
+    str
+        The file name.
+    """
+    fd, filename = tempfile.mkstemp(suffix=".yml")
+    try:
+        with os.fdopen(fd, "w") as fh:
+            json.dump({"custom_channels": conda_meta.get_custom_channels(channels)}, fh)
+        yield filename
+    finally:
+        os.unlink(filename)
+
+
+def install_single_solve(channels, specs, install_pkgs):
+    """
+    Install a list of specs with one solve and one transaction.
+
+    Parameters
+    ----------
+    channels : list
+        The channels to install from.
+    specs : list
+        The specs, as returned by `get_specs`.
+    install_pkgs : callable
+        The installer's install_pkgs function.
+    """
+    # so packages can be pinned to URL channels by name
+    with custom_channels_condarc(channels) as condarc:
+        install_pkgs(
+            {
+                "channels": channels,
+                "options": [],
+                "packages": specs,
+                "env": {"CONDARC": condarc},
+            }
+        )
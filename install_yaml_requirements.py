@@ -66,20 +66,10 @@ def insure_installed(module, package=None):
             raise SkaException("Conda is not installed") from None
 
 
-# These options are passed to conda_build.metadata.select_lines after reading meta.yaml.
-# This causes, for example, the lines that read " # [win]" to be read only on win-64.
-PLATFORM_OPTIONS = {
-    "linux-64": {"linux": True, "linux64": True},
-    "osx-64": {"osx": True, "osx64": True},
-    "win-64": {"win": True, "win64": True},
-}
-
-
 def install_pkgs(pkgs):
-    from conda_build.config import Config
+    from recipe_loader import get_conda_subdir
 
-    config = Config()
-    if config.platform not in pkgs["platforms"]:
+    if get_conda_subdir().split("-")[0] not in pkgs["platforms"]:
         return
 
     channels = sum([["-c", c] for c in pkgs["channels"]], [])
@@ -98,24 +88,26 @@ def install_pkgs(pkgs):
     subprocess.run(cmd, check=True)
 
 
-def install_yaml_requirements(meta_yaml, channels):
-    import yaml
-    from conda_build.config import Config
-    from conda_build.metadata import select_lines
+def install_yaml_requirements(meta_yaml, channels, environments=()):
+    from recipe_loader import get_conda_subdir, get_environment_specs, load_recipe
 
-    with open(meta_yaml) as fh:
-        meta = fh.read()
+    # lines with selectors (e.g. " # [win]") are read only on the corresponding platforms
+    subdir = get_conda_subdir()
+    data = load_recipe(meta_yaml, subdir=subdir, loader="base")
 
-    config = Config()
-    data = select_lines(meta, PLATFORM_OPTIONS[config.target_subdir], {})
-    data = yaml.load(data, Loader=yaml.BaseLoader)
-
-    dependencies = data["requirements"].get("run", [])
+    # environment files are installed in the same transaction
+    dependencies = []
+    channels = list(channels)
+    for env in environments:
+        env_channels, env_specs = get_environment_specs(env, subdir=subdir)
+        channels += [c for c in env_channels if c not in channels]
+        dependencies += env_specs
+    dependencies += data["requirements"].get("run", [])
     install_pkgs(
         {
             "channels": channels,
             "options": [],
-            "platforms": [config.platform],
+            "platforms": [subdir.split("-")[0]],
             "packages": dependencies,
         }
     )
@@ -125,6 +117,14 @@ def get_parser():
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument("yaml_file", type=pathlib.Path)
     parser.add_argument("-c", "--channel", action="append", default=[])
+    parser.add_argument(
+        "-e",
+        "--environment",
+        action="append",
+        default=[],
+        type=pathlib.Path,
+        help="Environment file whose dependencies are installed together with the requirements",
+    )
     return parser
 
 
@@ -135,7 +135,7 @@ def main():
 
     channels = get_channels(args)
     # insure_installed("yaml", "pyyaml")
-    install_yaml_requirements(args.yaml_file, channels=channels)
+    install_yaml_requirements(args.yaml_file, channels=channels, environments=args.environment)
 
 
 if __name__ == "__main__":
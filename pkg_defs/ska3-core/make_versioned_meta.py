@@ -1,7 +1,12 @@
-import subprocess
-import json
-result = subprocess.run(['conda', 'list', '--no-pip', '--json'], stdout=subprocess.PIPE)
-pkgs = json.loads(result.stdout)
+import pathlib
+import sys
+
+sys.path.insert(0, str(pathlib.Path(__file__).absolute().parents[2]))
+
+import conda_meta  # noqa: E402
+
+prefix = sys.argv[1] if len(sys.argv) > 1 else conda_meta.get_default_prefix()
+pkgs = conda_meta.read_prefix(prefix)
 for pkg in pkgs:
     if pkg['channel'] == 'defaults':
         print("   - {name} =={version}".format(**pkg))
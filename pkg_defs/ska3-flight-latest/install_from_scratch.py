@@ -1,14 +1,11 @@
 #!/usr/bin/env python
 
+import importlib
+import logging
 import os
-import sys
-import subprocess
 import pathlib
-import logging
-
-assert (
-    "CONDA_PASSWORD" in os.environ
-), "CONDA_PASSWORD environmental variable is not defined"
+import subprocess
+import sys
 
 CHANNELS = []
 SKA_CHANNELS = []
@@ -22,7 +19,9 @@ def get_package_list():
         {"channels": SKA_CHANNELS, "options": [], "packages": ["quaternion"]},
     ]
 
-# These options are passed to conda_build.metadata.select_lines after reading meta.yaml.
+
+# These options are passed to conda_build.metadata.select_lines after reading meta.yaml, when this
+# script is used outside of the skare3 repository (see load_meta_yaml).
 # This causes, for example, the lines that read " # [win]" to be read only on win-64.
 PLATFORM_OPTIONS = {
     "linux-64": {"linux": True, "linux64": True},
@@ -31,6 +30,34 @@ PLATFORM_OPTIONS = {
 }
 
 
+def import_from_repo(name):
+    """Import one of the modules at the top of the skare3 repository.
+
+    Raises ImportError if this script is not in the repository. Only --single-solve requires
+    these modules, so a copy of this script can still install packages in sequence.
+    """
+    repo_dir = str(pathlib.Path(__file__).absolute().parent.parent.parent)
+    if repo_dir not in sys.path:
+        sys.path.insert(0, repo_dir)
+    return importlib.import_module(name)
+
+
+def load_meta_yaml(meta_yaml, subdir):
+    """Read meta.yaml, keeping only the lines with selectors that apply to subdir."""
+    try:
+        recipe_loader = import_from_repo("recipe_loader")
+    except ImportError:
+        # imported here because they might not be present by default
+        import conda_build.metadata
+        import yaml
+
+        with open(meta_yaml) as fh:
+            meta = fh.read()
+        data = conda_build.metadata.select_lines(meta, PLATFORM_OPTIONS[subdir], {})
+        return yaml.load(data, Loader=yaml.BaseLoader)
+    return recipe_loader.load_recipe(meta_yaml, subdir=subdir, loader="base")
+
+
 def install_pkgs(pkgs):
     channels = sum([["-c", c] for c in pkgs["channels"]], [])
     if channels:
@@ -42,24 +69,17 @@ def install_pkgs(pkgs):
         + pkgs["packages"]
     )
     logging.info(" ".join(cmd))
-    proc = subprocess.run(cmd)
+    env = dict(os.environ, **pkgs["env"]) if "env" in pkgs else None
+    proc = subprocess.run(cmd, env=env)
     if proc.returncode != 0:
         raise RuntimeError(f"Error installing {pkgs['packages']}")
 
 
-def install_yaml_requirements(meta_yaml):
-    # imported here because they might not be present by default
-    import yaml
-    import conda_build.metadata
-
-    with open(meta_yaml) as fh:
-        meta = fh.read()
+def get_yaml_requirements(meta_yaml, subdir=None):
+    # we use "osx-64" by default because ska3-flight-latest should not depend on the platform
+    data = load_meta_yaml(meta_yaml, subdir or "osx-64")
 
-    # we use "osx-64" because ska3-flight-latest should not depend on the platform anyway
-    data = conda_build.metadata.select_lines(meta, PLATFORM_OPTIONS["osx-64"], {})
-    data = yaml.load(data, Loader=yaml.BaseLoader)
-
-    dependencies = sum(
+    return sum(
         [
             data["requirements"][k]
             for k in ["build", "run"]
@@ -67,15 +87,52 @@ def install_yaml_requirements(meta_yaml):
         ],
         [],
     )
+
+
+def install_yaml_requirements(meta_yaml):
     install_pkgs(
         {
             "channels": CHANNELS + SKA_CHANNELS,
             "options": [],
-            "packages": dependencies,
+            "packages": get_yaml_requirements(meta_yaml),
         }
     )
 
 
+def get_specs(subdir=None):
+    """All packages to install (environment files, pre-packages and meta.yaml) in a single list.
+
+    Returns a tuple (channels, specs). See install_specs.get_specs.
+    """
+    recipe_loader = import_from_repo("recipe_loader")
+    install_specs = import_from_repo("install_specs")
+
+    meta_yaml = pathlib.Path(__file__).parent / "meta.yaml"
+    return install_specs.get_specs(
+        pathlib.Path(__file__).parent,
+        get_package_list(),
+        CHANNELS + SKA_CHANNELS,
+        get_yaml_requirements(meta_yaml, subdir),
+        subdir or recipe_loader.get_conda_subdir(),
+    )
+
+
+def install_single_solve():
+    """Install all packages in get_specs() with one solve and one transaction."""
+    install_specs = import_from_repo("install_specs")
+    install_specs.install_single_solve(*get_specs(), install_pkgs)
+
+
+def set_channels(conda_channels=(), ska_channels=()):
+    """Set the channels used to install packages (conda-forge if no conda channel is given)."""
+    CHANNELS[:] = list(conda_channels) or ["conda-forge"]
+    SKA_CHANNELS[:] = [
+        f'https://ska:{os.environ["CONDA_PASSWORD"]}'
+        f"@cxc.cfa.harvard.edu/mta/ASPECT/ska3-conda/{channel}"
+        for channel in ska_channels
+    ]
+
+
 def get_parser():
     import argparse
 
@@ -88,6 +145,12 @@ def get_parser():
     parser.add_argument(
         "--conda-channel", action="append", default=[], help="Conda channels to use"
     )
+    parser.add_argument(
+        "--single-solve",
+        action="store_true",
+        help="Install environment files, pre-packages and meta.yaml requirements "
+        "with a single solve",
+    )
     return parser
 
 
@@ -96,22 +159,21 @@ def main():
 
     args = get_parser().parse_args()
 
-    if not args.conda_channel:
-        args.conda_channel.append("conda-forge")
+    assert (
+        "CONDA_PASSWORD" in os.environ
+    ), "CONDA_PASSWORD environmental variable is not defined"
 
-    for channel in args.conda_channel:
-        CHANNELS.append(channel)
-    for channel in args.ska_channel:
-        SKA_CHANNELS.append(
-            f'https://ska:{os.environ["CONDA_PASSWORD"]}'
-            f"@cxc.cfa.harvard.edu/mta/ASPECT/ska3-conda/{channel}"
-        )
+    set_channels(args.conda_channel, args.ska_channel)
 
     if not SKA_CHANNELS:
         logging.error("No ska channels specified")
         sys.exit(1)
 
     try:
+        if args.single_solve:
+            install_single_solve()
+            return
+
         for pkgs in get_package_list():
             install_pkgs(pkgs)
 
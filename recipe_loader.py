@@ -0,0 +1,278 @@
+"""
+Load conda build recipes (meta.yaml files) the same way in all skare3 scripts.
+
+Recipes can be rendered with jinja2 (using stubs for the conda-build jinja macros) and, if a
+conda subdir is given, lines are selected according to their selectors (e.g. "# [win]") the
+same way conda_build.metadata.select_lines does, but without importing conda_build.
+
+Parsed recipes are memoized. Each entry is invalidated when the file's modification time or size
+change and its content hash changes too. The memoized recipes can also be kept in an on-disk
+pickle file (see `set_cache_file`) so they are shared between processes.
+"""
+
+import atexit
+import copy
+import hashlib
+import json
+import os
+import pickle
+import platform
+import re
+import tempfile
+import threading
+from pathlib import Path
+
+PKG_DEFS_PATH = Path(__file__).parent / "pkg_defs"
+
+# these are macros to be able to parse meta.yaml files which use them
+# clearly, these do not do anything useful, just allow parsing to proceed
+JINJA_MACROS = """
+{% macro compiler(arg) %}{% endmacro %}
+{% macro pin_compatible(arg) %}arg{% endmacro %}
+"""
+
+LOADERS = {
+    "safe": ("CSafeLoader", "SafeLoader"),
+    "base": ("CBaseLoader", "BaseLoader"),
+}
+
+# same pattern conda-build uses to find selectors
+SELECTOR_PATTERN = re.compile(r"(.+?)\s*(#.*)?\[([^\[\]]+)\](?(2)[^\(\)]*)$")
+
+_CACHE = {}
+_CACHE_LOCK = threading.RLock()
+# the pickle file (see set_cache_file) and whether _CACHE changed since it was saved
+_CACHE_STATE = {"file": None, "dirty": False}
+
+
+def get_conda_subdir():
+    """
+    The conda subdir of this machine (or the one given by the CONDA_SUBDIR variable).
+    """
+    if os.environ.get("CONDA_SUBDIR"):
+        return os.environ["CONDA_SUBDIR"]
+    system = {"Linux": "linux", "Darwin": "osx", "Windows": "win"}[platform.system()]
+    machine = platform.machine().lower()
+    if machine in ("arm64", "aarch64"):
+        return f"{system}-aarch64" if system == "linux" else f"{system}-arm64"
+    return f"{system}-64"
+
+
+def get_selector_namespace(subdir, python=None, numpy=None):
+    """
+    The variables that can be used in selectors when building for a given conda subdir.
+
+    This is a subset of the namespace conda-build uses. Variables not included here evaluate to
+    False in selectors.
+    """
+    system, _, arch = subdir.partition("-")
+    namespace = {
+        "linux": system == "linux",
+        "osx": system == "osx",
+        "win": system == "win",
+        "unix": system in ("linux", "osx"),
+        "linux64": subdir == "linux-64",
+        "osx64": subdir == "osx-64",
+        "win64": subdir == "win-64",
+        "x86": arch in ("32", "64"),
+        "x86_64": arch == "64",
+        "arm64": arch == "arm64",
+        "aarch64": arch == "aarch64",
+    }
+    if python is not None:
+        major, minor = str(python).split(".")[:2]
+        namespace.update(
+            {"py": int(f"{major}{minor}"), "py3k": major == "3", "py2k": major == "2"}
+        )
+    if numpy is not None:
+        major, minor = str(numpy).split(".")[:2]
+        namespace["np"] = int(f"{major}{minor}")
+    return namespace
+
+
+class _SelectorNamespace(dict):
+    # conda-build treats undefined names in selectors as False
+    def __missing__(self, key):
+        return False
+
+
+def select_lines(text, namespace):
+    """
+    Select the lines of a recipe according to their selectors.
+
+    This does the same as conda_build.metadata.select_lines.
+    """
+    namespace = _SelectorNamespace(namespace)
+    lines = []
+    for raw_line in text.splitlines():
+        line = raw_line.rstrip()
+        trailing_quote = line[-1] if line and line[-1] in ("'", '"') else ""
+        if line.lstrip().startswith("#"):
+            continue
+        if match := SELECTOR_PATTERN.match(line):
+            if eval(match.group(3), {"__builtins__": {}}, namespace):
+                lines.append(match.group(1) + trailing_quote)
+        else:
+            lines.append(line)
+    return "\n".join(lines) + "\n"
+
+
+def render(text, context=None):
+    """
+    Render a recipe with jinja2, using stubs for the conda-build macros.
+    """
+    import jinja2
+
+    return jinja2.Template(JINJA_MACROS + text).render(**(context or {}))
+
+
+def _context_key(context):
+    if not context:
+        return None
+    text = json.dumps(context, sort_keys=True, default=dict)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def load_recipe(
+    path,
+    *,
+    subdir=None,
+    python=None,
+    numpy=None,
+    jinja=False,
+    context=None,
+    loader="safe",
+):
+    """
+    Load a recipe.
+
+    Parameters
+    ----------
+    path : str or Path
+        The meta.yaml file or the directory containing it.
+    subdir : str
+        Conda subdir (e.g. "linux-64") used to select lines. If None, no selection is done and
+        selectors are just comments.
+    python : str
+        Python version (e.g. "3.13") for the "py" selector variables.
+    numpy : str
+        Numpy version (e.g. "2.3") for the "np" selector variable.
+    jinja : bool
+        Whether to render the recipe with jinja2 before parsing.
+    context : dict
+        The jinja context (e.g. {"environ": os.environ}).
+    loader : str
+        "safe" (yaml.SafeLoader) or "base" (yaml.BaseLoader, where all values are strings).
+
+    Returns
+    -------
+    dict
+        The parsed recipe. This is a copy, so it can be modified by the caller.
+    """
+    path = Path(path)
+    if path.is_dir():
+        path = path / "meta.yaml"
+    path = path.absolute()
+    key = (
+        str(path),
+        subdir,
+        python,
+        numpy,
+        jinja,
+        _context_key(context) if jinja else None,
+        loader,
+    )
+
+    stat = path.stat()
+    signature = (stat.st_mtime_ns, stat.st_size)
+    with _CACHE_LOCK:
+        entry = _CACHE.get(key)
+    if entry is not None and entry["signature"] == signature:
+        return copy.deepcopy(entry["data"])
+
+    content = path.read_bytes()
+    sha256 = hashlib.sha256(content).hexdigest()
+    if entry is not None and entry["sha256"] == sha256:
+        # touched but not modified
+        data = entry["data"]
+    else:
+        text = content.decode()
+        if jinja:
+            text = render(text, context)
+        if subdir is not None:
+            text = select_lines(
+                text, get_selector_namespace(subdir, python=python, numpy=numpy)
+            )
+        data = _load_yaml(text, loader)
+
+    with _CACHE_LOCK:
+        _CACHE[key] = {"signature": signature, "sha256": sha256, "data": data}
+        _CACHE_STATE["dirty"] = True
+    return copy.deepcopy(data)
+
+
+def get_environment_specs(path, subdir=None):
+    """
+    Get the channels and package specs in a conda environment file.
+
+    Selectors are applied the same way as in recipes. pip requirements are not included.
+
+    Returns
+    -------
+    tuple
+        (channels, specs)
+    """
+    data = load_recipe(path, subdir=subdir, loader="base") or {}
+    specs = [
+        spec for spec in data.get("dependencies", []) if isinstance(spec, str)
+    ]
+    return data.get("channels", []), specs
+
+
+def _load_yaml(text, loader):
+    # yaml is imported here so this module (e.g. get_conda_subdir) can be used by the installers
+    # before pyyaml is installed
+    import yaml
+
+    c_loader, py_loader = LOADERS[loader]
+    return yaml.load(text, Loader=getattr(yaml, c_loader, getattr(yaml, py_loader)))
+
+
+def set_cache_file(filename):
+    """
+    Keep memoized recipes in a pickle file.
+
+    Entries in the file are loaded now, and all entries are saved when the process exits.
+    """
+    filename = Path(filename)
+    with _CACHE_LOCK:
+        if _CACHE_STATE["file"] is None:
+            atexit.register(save_cache)
+        _CACHE_STATE["file"] = filename
+        if filename.exists():
+            try:
+                with open(filename, "rb") as fh:
+                    entries = pickle.load(fh)
+            except Exception:
+                # a stale or broken cache is just ignored
+                entries = {}
+            for key, entry in entries.items():
+                _CACHE.setdefault(key, entry)
+
+
+def save_cache():
+    with _CACHE_LOCK:
+        cache_file = _CACHE_STATE["file"]
+        if cache_file is None or not _CACHE_STATE["dirty"]:
+            return
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        # write and rename, so concurrent processes never see a partial file
+        fd, tmp_name = tempfile.mkstemp(dir=cache_file.parent, suffix=".tmp")
+        with os.fdopen(fd, "wb") as fh:
+            pickle.dump(_CACHE, fh)
+        os.replace(tmp_name, cache_file)
+        _CACHE_STATE["dirty"] = False
+
+
+if os.environ.get("SKARE3_RECIPE_CACHE"):
+    set_cache_file(os.environ["SKARE3_RECIPE_CACHE"])
@@ -0,0 +1,235 @@
+"""
+Local cache of conda channel metadata (repodata.json and other files served by channels).
+
+Files from remote channels are kept in a cache directory together with their ETag and
+Last-Modified headers, and are revalidated with a conditional request (If-None-Match and
+If-Modified-Since), so an unchanged file costs one round-trip and no download. If the zstandard
+module is available, repodata.json.zst is requested instead of repodata.json (falling back to the
+latter if the server does not have it).
+
+Parsed repodata is stored as a pickle next to the raw data, so it is not parsed again while the
+upstream file does not change. Local channels (directories or file:// URLs) are handled the same
+way, but they are validated using the file's modification time and size.
+
+The cache directory is given by the SKARE3_CACHE_DIR environment variable, and defaults to
+~/.cache/skare3.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import pickle
+import tempfile
+import threading
+import time
+from pathlib import Path
+from urllib.parse import unquote, urlparse
+
+import requests
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger("skare3")
+
+DEFAULT_CACHE_DIR = Path(
+    os.environ.get("SKARE3_CACHE_DIR", Path.home() / ".cache" / "skare3")
+)
+
+# seconds before checking again whether a server without repodata.json.zst has it now
+NO_ZST_TTL = 24 * 3600
+
+# size of the chunks written to the cache while downloading
+CHUNK_SIZE = 1 << 20
+
+_LOCKS = {}
+_LOCKS_LOCK = threading.Lock()
+
+
+def _lock(key):
+    # one lock per cache entry, so the same file is not fetched twice at the same time
+    with _LOCKS_LOCK:
+        return _LOCKS.setdefault(key, threading.Lock())
+
+
+def get_local_path(url):
+    """
+    The local path of a channel URL, or None if the channel is not local.
+    """
+    url = str(url)
+    if url.startswith("file://"):
+        return Path(unquote(urlparse(url).path))
+    if "://" not in url:
+        return Path(url)
+
+
+def _cache_path(url, cache_dir, kind):
+    # the key is a hash of the URL, so credentials in the URL do not end up in file names
+    key = hashlib.sha256(url.encode()).hexdigest()
+    return Path(cache_dir or DEFAULT_CACHE_DIR) / kind / key[:2] / key
+
+
+def _write(filename, data):
+    # write and rename, so concurrent processes never see a partial file.
+    # data is bytes or an iterable of chunks (so large downloads are never held in memory)
+    if isinstance(data, bytes):
+        data = [data]
+    filename.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_name = tempfile.mkstemp(dir=filename.parent, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as fh:
+            for chunk in data:
+                fh.write(chunk)
+        os.replace(tmp_name, filename)
+    except BaseException:
+        os.unlink(tmp_name)
+        raise
+
+
+def _read_info(filename):
+    try:
+        with open(filename) as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return None
+
+
+def fetch(url, session=None, cache_dir=None):
+    """
+    Get a file from a channel, using the cache.
+
+    Parameters
+    ----------
+    url : str
+        URL of the file. It can also be a file:// URL or a local path.
+    session : requests.Session
+        Session used for remote files.
+    cache_dir : Path
+        The cache directory (default: DEFAULT_CACHE_DIR).
+
+    Returns
+    -------
+    Path
+        The path of the (cached) file, or None if it does not exist.
+    """
+    local_path = get_local_path(url)
+    if local_path is not None:
+        return local_path if local_path.exists() else None
+
+    session = requests if session is None else session
+    filename = _cache_path(url, cache_dir, "http")
+    info_file = filename.with_suffix(".info")
+    with _lock(filename):
+        info = _read_info(info_file) if filename.exists() else None
+        headers = {}
+        if info is not None:
+            if info.get("etag"):
+                headers["If-None-Match"] = info["etag"]
+            if info.get("last_modified"):
+                headers["If-Modified-Since"] = info["last_modified"]
+
+        with session.get(url, headers=headers, stream=True, timeout=60) as r:
+            if r.status_code == 304:
+                logger.debug(f"Not modified: {url}")
+                return filename
+            if r.status_code == 404:
+                return None
+            r.raise_for_status()
+            _write(filename, r.iter_content(CHUNK_SIZE))
+            logger.debug(f"Downloaded: {url}")
+            info = {
+                "etag": r.headers.get("ETag"),
+                "last_modified": r.headers.get("Last-Modified"),
+            }
+        _write(info_file, json.dumps(info).encode())
+        return filename
+
+
+def _load_pickle(filename, signature):
+    try:
+        with open(filename, "rb") as fh:
+            entry = pickle.load(fh)
+    except Exception:
+        # a missing, stale or broken pickle is just ignored
+        return None
+    if entry["signature"] == signature:
+        return entry["data"]
+
+
+def _parse(filename, url, cache_dir, compressed=False):
+    """
+    Parse a (cached) JSON file, reusing the pickled result if the file did not change.
+    """
+    stat = filename.stat()
+    signature = (str(filename.absolute()), stat.st_mtime_ns, stat.st_size)
+    pickle_file = _cache_path(url, cache_dir, "parsed")
+    with _lock(pickle_file):
+        data = _load_pickle(pickle_file, signature)
+        if data is None:
+            content = filename.read_bytes()
+            if compressed:
+                content = zstandard.ZstdDecompressor().decompressobj().decompress(content)
+            data = json.loads(content)
+            _write(
+                pickle_file,
+                pickle.dumps(
+                    {"signature": signature, "data": data},
+                    protocol=pickle.HIGHEST_PROTOCOL,
+                ),
+            )
+    return data
+
+
+def get_json(url, session=None, cache_dir=None):
+    """
+    Get and parse a JSON file from a channel, using the cache.
+
+    Returns None if the file does not exist.
+    """
+    filename = fetch(url, session=session, cache_dir=cache_dir)
+    if filename is not None:
+        return _parse(filename, url, cache_dir)
+
+
+def get_repodata(channel_url, subdir, session=None, cache_dir=None):
+    """
+    Get the repodata of a channel's subdir, using the cache.
+
+    Parameters
+    ----------
+    channel_url : str
+        The channel URL. It can also be a file:// URL or a local directory.
+    subdir : str
+        The conda subdir (e.g. "noarch" or "linux-64").
+    session : requests.Session
+        Session used for remote channels.
+    cache_dir : Path
+        The cache directory (default: DEFAULT_CACHE_DIR).
+
+    Returns
+    -------
+    dict
+        The repodata, or None if the channel does not have this subdir.
+    """
+    url = f"{str(channel_url).rstrip('/')}/{subdir}/repodata.json"
+    if zstandard is not None and get_local_path(url) is None:
+        # remember (for a day) that the server has no .zst file, to avoid a failed request
+        no_zst_file = _cache_path(url, cache_dir, "http").with_suffix(".no-zst")
+        if (
+            not no_zst_file.exists()
+            or time.time() - no_zst_file.stat().st_mtime > NO_ZST_TTL
+        ):
+            # any HTTP error means there is no .zst file (some servers and proxies answer with
+            # 403 or 5xx instead of 404). Errors are only raised for the uncompressed file.
+            try:
+                filename = fetch(f"{url}.zst", session=session, cache_dir=cache_dir)
+            except (requests.HTTPError, requests.exceptions.RetryError) as exc:
+                logger.debug(f"Could not get {url}.zst: {exc}")
+                filename = None
+            if filename is not None:
+                return _parse(filename, f"{url}.zst", cache_dir, compressed=True)
+            _write(no_zst_file, b"")
+    return get_json(url, session=session, cache_dir=cache_dir)
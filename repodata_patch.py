@@ -0,0 +1,138 @@
+"""
+Apply repodata patch instructions to repodata, and compare repodata before and after patching.
+
+Patch instructions are applied the same way conda-index does it:
+
+- entries in "packages"/"packages.conda" update the fields of existing records (patches for
+  packages that are not in the repodata are ignored),
+- patches in "packages" also apply to packages.conda (for a .tar.bz2 package, to the .conda
+  package with the same name),
+- revoked packages get "revoked": true and a dependency on "package_has_been_revoked",
+- removed packages are taken out of the repodata and listed in "removed".
+
+Patch instructions are first compiled into dictionaries keyed by the filenames they apply to, so
+applying them takes one dictionary lookup per record (or per instruction, whichever is fewer).
+Patching does not modify its input: records that change are copied and all others are shared
+with the original repodata, which also makes comparing the two cheap.
+"""
+
+TAR_BZ2 = ".tar.bz2"
+CONDA = ".conda"
+PKGS_KEYS = ("packages", "packages.conda")
+
+
+def _conda_filename(fn):
+    return fn[: -len(TAR_BZ2)] + CONDA if fn.endswith(TAR_BZ2) else fn
+
+
+def compile_patch_instructions(instructions):
+    """
+    Index patch instructions by the filenames they apply to.
+
+    Parameters
+    ----------
+    instructions : dict
+        Patch instructions for one subdir (with keys "packages", "packages.conda", "revoke" and
+        "remove").
+
+    Returns
+    -------
+    dict
+        With keys "packages" and "packages.conda" (the fields to update for each filename, with
+        the fixes in "packages" already merged into the corresponding .conda filenames), and
+        "revoke" and "remove" (sets of filenames, including the .conda names of .tar.bz2
+        packages).
+    """
+    if instructions.get("compiled"):
+        return instructions
+    fixes = instructions.get("packages", {})
+    # like conda-index, every fix in "packages" also applies to packages.conda (after renaming
+    # .tar.bz2 to .conda), including fixes listed there under a .conda name
+    conda_fixes = {_conda_filename(fn): fix for fn, fix in fixes.items()}
+    for fn, fix in instructions.get("packages.conda", {}).items():
+        # explicit .conda fixes are applied after the ones from "packages", so they take precedence
+        conda_fixes[fn] = {**conda_fixes[fn], **fix} if fn in conda_fixes else fix
+    revoke = set(instructions.get("revoke", ()))
+    remove = set(instructions.get("remove", ()))
+    return {
+        "compiled": True,
+        "packages": fixes,
+        "packages.conda": conda_fixes,
+        "revoke": revoke | {_conda_filename(fn) for fn in revoke},
+        "remove": remove | {_conda_filename(fn) for fn in remove},
+    }
+
+
+def _matches(records, filenames):
+    # the filenames in both, iterating over the smaller one
+    if len(filenames) < len(records):
+        return [fn for fn in filenames if fn in records]
+    return [fn for fn in records if fn in filenames]
+
+
+def patch_repodata(repodata, instructions):
+    """
+    Apply patch instructions to repodata.
+
+    Parameters
+    ----------
+    repodata : dict
+        The repodata of one subdir. It is not modified.
+    instructions : dict
+        Patch instructions for the same subdir, or the output of `compile_patch_instructions`.
+
+    Returns
+    -------
+    dict
+        The patched repodata. Records that were not patched are shared with the input.
+    """
+    instructions = compile_patch_instructions(instructions)
+    result = dict(repodata)
+    removed = set(repodata.get("removed", ()))
+    for key in PKGS_KEYS:
+        records = dict(repodata.get(key, {}))
+        fixes = instructions[key]
+        for fn in _matches(records, fixes):
+            records[fn] = {**records[fn], **fixes[fn]}
+        for fn in _matches(records, instructions["revoke"]):
+            record = records[fn]
+            depends = record.get("depends", [])
+            if "package_has_been_revoked" not in depends:
+                depends = depends + ["package_has_been_revoked"]
+            records[fn] = {**record, "revoked": True, "depends": depends}
+        for fn in _matches(records, instructions["remove"]):
+            del records[fn]
+            removed.add(fn)
+        result[key] = records
+    result["removed"] = sorted(removed)
+    return result
+
+
+def diff_repodata(before, after):
+    """
+    Compare two versions of a subdir's repodata (usually before and after patching).
+
+    Returns
+    -------
+    dict
+        With keys "added" and "removed" (lists of filenames) and "changed" (a dictionary keyed by
+        filename, with the changed fields as a dictionary of [before, after] pairs).
+    """
+    diff = {"added": [], "removed": [], "changed": {}}
+    for key in PKGS_KEYS:
+        old_records = before.get(key, {})
+        new_records = after.get(key, {})
+        diff["added"] += [fn for fn in new_records if fn not in old_records]
+        for fn, old in old_records.items():
+            new = new_records.get(fn)
+            if new is None:
+                diff["removed"].append(fn)
+            elif new is not old and new != old:
+                diff["changed"][fn] = {
+                    field: [old.get(field), new.get(field)]
+                    for field in old.keys() | new.keys()
+                    if old.get(field) != new.get(field)
+                }
+    diff["added"].sort()
+    diff["removed"].sort()
+    return diff
@@ -1,20 +1,30 @@
 #!/usr/bin/env python
 
 import argparse
+import collections
+import contextlib
+import datetime
+import hashlib
+import json
 import os
 import platform
 import re
 import shutil
+import statistics
 import subprocess
 import sys
 import tempfile
+import threading
 import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from fnmatch import fnmatch
 from pathlib import Path
 
 import git
-import jinja2
-import yaml
+from packaging.version import InvalidVersion, Version
+
+from recipe_loader import get_conda_subdir, load_recipe
+from repodata_cache import get_repodata
 
 PKG_DEFS_PATH = Path(__file__).parent / 'pkg_defs'
 
@@ -43,6 +53,46 @@ def get_opt():
     parser.add_argument("--force",
                         action="store_true",
                         help="Force build of package even if it exists")
+    parser.add_argument("--build-cache",
+                        help="Directory with previously built packages, keyed by a hash of the "
+                        "recipe, source commit and build options. Packages found there are copied "
+                        "instead of built, and built packages are added to it "
+                        "(default: no build cache)")
+    parser.add_argument("--timings",
+                        help="JSON-lines file where the time of each build phase is recorded "
+                        "(default=<build-root>/build_timings.jsonl)")
+    parser.add_argument("--report",
+                        action="store_true",
+                        help="Do not build. Report the slowest packages, regressions and the "
+                        "critical path, from the recorded build timings")
+    parser.add_argument("--no-plan",
+                        action="store_true",
+                        help="Do not check which packages are already built before cloning. "
+                        "Already built packages are then skipped by conda build. Note that the "
+                        "check can only tell the version of packages built from git with --tag "
+                        "or --git-cache. Otherwise they are always cloned")
+    parser.add_argument("--in-process",
+                        action="store_true",
+                        help="Build using the conda_build API within this process, instead of "
+                        "running 'conda build' for each package, so conda and the channel "
+                        "indices are loaded only once. The conda_build API is not thread-safe, "
+                        "so this can not be used with --jobs")
+    parser.add_argument("--on-failure",
+                        default="ask",
+                        choices=["ask", "stop", "continue", "skip-dependents"],
+                        help="What to do when a package fails: ask whether to continue, stop, "
+                        "continue with all other packages, or continue skipping only the packages "
+                        "that require the failed one (directly or not). With --jobs, 'ask' is the "
+                        "same as 'stop' and 'continue' the same as 'skip-dependents' "
+                        "(default=ask)")
+    parser.add_argument("--summary",
+                        help="JSON file where to write the lists of built, failed and skipped "
+                        "packages")
+    parser.add_argument("--jobs", "-j",
+                        default=1, type=int,
+                        help="Number of packages to build concurrently. If larger than 1, packages "
+                        "are built as soon as all their requirements in the build list are built, "
+                        "each in its own croot (default=1)")
     parser.add_argument("--arch-specific",
                         action="store_true",
                         help="Build only architecture-specific packages")
@@ -60,6 +110,12 @@ def get_opt():
                         "except on Windows")
     parser.add_argument("--repo-url",
                         help="Use this URL instead of meta['about']['home']")
+    parser.add_argument("--git-cache",
+                        help="Directory with bare mirrors of the upstream repositories. Mirrors "
+                        "are created the first time and fetched incrementally afterwards, and "
+                        "the sources are cloned from them. This is also what lets the planner "
+                        "find the latest tag of each package without cloning, so rebuilding "
+                        "already-built packages is fast (default: clone from upstream)")
     parser.add_argument("--channel", "-c", help="channel", action="append", default=[])
     parser.add_argument("--override-channels", action="store_true", default=False)
     parser.add_argument('--ska3-overwrite-version',
@@ -70,14 +126,19 @@ def get_opt():
                              "pre-release portion of the version string removed.")
 
     args = parser.parse_args()
+    if args.in_process and args.jobs > 1:
+        # conda_build changes process-wide state, and its output can not be sent to per-package
+        # log files
+        parser.error("--in-process can not be used with --jobs")
     return args
 
 
-def clone_repo(name, args, src_dir, meta):
-    tag = args.tag
-    print("  - Cloning or updating source: %s." % name)
-    clone_path = os.path.join(src_dir, name)
+def get_repo_urls(args, meta):
+    """
+    URLs of the repository of a package.
 
+    :return: tuple (url, upstream_url). The URL for cloning and the upstream URL for the tags.
+    """
     # Upstream (home) URL is for the tags
     upstream_url = meta['about'].get("dev_url", meta['about']['home'])
 
@@ -91,57 +152,264 @@ def clone_repo(name, args, src_dir, meta):
             url = url.replace('git@github.com:', 'https://github.com/')
         else:
             url = url.replace('https://github.com/', 'git@github.com:')
+    return url, upstream_url
 
-    repo = git.Repo.clone_from(url, clone_path)
-    print("  - Cloned from url {}".format(url))
-
-    if args.repo_url:
-        # Get tags from the upstream URL
-        repo.create_remote('upstream', upstream_url)
-        repo.remotes.upstream.fetch()
 
+def get_latest_tag(repo):
     # I think we want the commit/tag with the most recent date, though
     # if we actually want the most recently created tag, that would probably be
     # tags = sorted(repo.tags, key=lambda t: t.tag.tagged_date)
     # I suppose we could also use github to get the most recent release (not tag)
+    tags = sorted(repo.tags, key=lambda t: t.commit.committed_datetime)
+    return tags[-1]
+
+
+# one lock per mirror, so concurrent builds do not update the same mirror at the same time
+_MIRROR_LOCKS = {}
+# mirrors already created or updated in this run (e.g. while planning), which are not fetched again
+_UPDATED_MIRRORS = set()
+
+
+def get_mirror_path(url, git_cache):
+    """
+    Path to the bare mirror of a repository in the git cache.
+
+    The same repository gets the same mirror whether it is accessed with ssh or https.
+    """
+    name = re.sub(r"^(\w+://)?([^@/]+@)?", "", url)
+    name = re.sub(r"\.git$", "", name)
+    name = re.sub(r"[^\w.-]+", "_", name)
+    return Path(git_cache).absolute() / f"{name}.git"
+
+
+def update_mirror(url, git_cache):
+    """
+    Create or incrementally update the bare mirror of a repository in the git cache.
+
+    Each mirror is updated at most once per run.
+
+    :param url: str. The repository URL.
+    :param git_cache: str or Path. Directory with the mirrors.
+    :return: Path. The mirror path.
+    """
+    mirror_path = get_mirror_path(url, git_cache)
+    with _MIRROR_LOCKS.setdefault(mirror_path, threading.Lock()):
+        if mirror_path in _UPDATED_MIRRORS:
+            return mirror_path
+        if mirror_path.exists():
+            mirror = git.Repo(mirror_path)
+            mirror.remotes.origin.set_url(url)
+            mirror.git.remote("update", "--prune")
+            print(f"  - Updated mirror {mirror_path}")
+        else:
+            mirror_path.parent.mkdir(parents=True, exist_ok=True)
+            git.Repo.clone_from(url, str(mirror_path), mirror=True)
+            print(f"  - Created mirror {mirror_path}")
+        _UPDATED_MIRRORS.add(mirror_path)
+    return mirror_path
+
+
+def clone_repo(name, args, src_dir, meta):
+    tag = args.tag
+    print("  - Cloning or updating source: %s." % name)
+    clone_path = os.path.join(src_dir, name)
+
+    url, upstream_url = get_repo_urls(args, meta)
+
+    with timed("clone"):
+        if args.git_cache:
+            mirror_path = update_mirror(url, args.git_cache)
+            # --shared makes the clone use the mirror's objects instead of copying them
+            repo = git.Repo.clone_from(str(mirror_path), clone_path, shared=True)
+            repo.remotes.origin.set_url(url)
+            print("  - Cloned from mirror {} of url {}".format(mirror_path, url))
+        else:
+            repo = git.Repo.clone_from(url, clone_path)
+            print("  - Cloned from url {}".format(url))
+
+        if args.repo_url:
+            # Get tags from the upstream URL
+            if args.git_cache:
+                repo.create_remote("upstream", str(update_mirror(upstream_url, args.git_cache)))
+            else:
+                repo.create_remote("upstream", upstream_url)
+            repo.remotes.upstream.fetch()
+
+    with timed("checkout"):
+        return checkout_tag(repo, tag)
+
+
+def checkout_tag(repo, tag):
     if tag is None:
-        tags = sorted(repo.tags, key=lambda t: t.commit.committed_datetime)
-        repo.git.checkout(tags[-1].name)
+        latest_tag = get_latest_tag(repo)
+        repo.git.checkout(latest_tag.name)
         # Check to see if heads has master or main
         head_name = 'master' if hasattr(repo.heads, 'master') else 'main'
-        if tags[-1].commit == getattr(repo.heads, head_name).commit:
-            print(f"  - Auto-checked out at {tags[-1].name} which is also tip of {head_name}")
+        if latest_tag.commit == getattr(repo.heads, head_name).commit:
+            print(f"  - Auto-checked out at {latest_tag.name} which is also tip of {head_name}")
         else:
-            print(f"  - Auto-checked out at {tags[-1].name} NOT AT tip of {head_name}")
-        args.tag = tags[-1].name  # set for later use
+            print(f"  - Auto-checked out at {latest_tag.name} NOT AT tip of {head_name}")
+        tag = latest_tag.name
     else:
         repo.git.checkout(tag)
         print(f'  - Checked out at {tag} and pulled')
 
+    return tag
+
+
+# versions are cached by repository and commit, so each commit is described only once per run
+_SCM_VERSIONS = {}
+
+# setuptools_scm settings that write files, which is left to the package's own build
+_SCM_WRITE_OPTIONS = ("write_to", "write_to_template", "version_file", "version_file_template")
+
 
-def build_package(name, args, src_dir, build_dir, conda_args=None):
+def get_scm_config(root):
+    """
+    Get the [tool.setuptools_scm] settings of a repository.
+
+    :param root: Path. The repository's working tree.
+    :return: dict. Empty if the repository has no pyproject.toml or no such section.
+    """
+    pyproject = Path(root) / "pyproject.toml"
+    if not pyproject.exists():
+        return {}
+    try:
+        import tomllib
+    except ImportError:  # python < 3.11
+        import tomli as tomllib
+    with open(pyproject, "rb") as fh:
+        return tomllib.load(fh).get("tool", {}).get("setuptools_scm", {})
+
+
+def get_scm_version(repo):
+    """
+    Get the version setuptools_scm gives to a repository.
+
+    setuptools_scm is called in-process with the repository's [tool.setuptools_scm] settings
+    (version_scheme, local_scheme, tag_regex...), so the version is the same the package reports
+    at runtime. Versions of clean working trees are cached by repository and commit.
+
+    :param repo: git.Repo
+    :return: str
+    """
+    import setuptools_scm
+
+    root = Path(repo.working_tree_dir).absolute()
+    key = (str(root), repo.head.commit.hexsha)
+    dirty = repo.is_dirty(untracked_files=False)
+    if not dirty and key in _SCM_VERSIONS:
+        return _SCM_VERSIONS[key]
+
+    config = {k: v for k, v in get_scm_config(root).items() if k not in _SCM_WRITE_OPTIONS}
+    # "root" is relative to pyproject.toml, as when setuptools_scm reads the file itself
+    config["root"] = str((root / config.get("root", ".")).resolve())
+    config.pop("relative_to", None)
+    version = setuptools_scm.get_version(**config)
+
+    if not dirty:
+        _SCM_VERSIONS[key] = version
+    return version
+
+
+def build_package(name, args, src_dir, build_dir, conda_args=None, *, tag=None, log_file=None):
     if conda_args is None:
         conda_args = []
+    if tag is None:
+        tag = args.tag
     pkg_path = Path(src_dir) / 'pkg_defs' / name
-    shutil.copytree(PKG_DEFS_PATH / name, pkg_path)
+    with timed("render"):
+        shutil.copytree(PKG_DEFS_PATH / name, pkg_path)
 
-    if args.ska3_overwrite_version and re.match(r'ska3-\S+$', name):
-        skare3_old_version, skare3_new_version = args.ska3_overwrite_version.split(':')
-        print(f'  - overwriting skare3 meta-package version '
-              f'{skare3_old_version} -> {skare3_new_version}')
-        overwrite_skare3_version(skare3_old_version, skare3_new_version, pkg_path)
+        if args.ska3_overwrite_version and re.match(r"ska3-\S+$", name):
+            skare3_old_version, skare3_new_version = args.ska3_overwrite_version.split(":")
+            print(f"  - overwriting skare3 meta-package version "
+                  f"{skare3_old_version} -> {skare3_new_version}")
+            overwrite_skare3_version(skare3_old_version, skare3_new_version, pkg_path)
 
-    try:
-        version = subprocess.check_output(['python', '-m', 'setuptools_scm'],
-                                          cwd=os.path.join(src_dir, name))
-        version = version.decode().split()[-1].strip()
-        print(f'  - SKA_PKG_VERSION={version} (from setuptools_scm)')
-    except Exception:
-        version = args.tag
+    with timed("version"):
+        version = get_package_version(Path(src_dir) / name, tag)
+    timer = get_timer()
+    if timer is not None:
+        timer.version = version
+
+    cache_key = None
+    if args.build_cache:
+        cache_key = get_build_cache_key(name, args, src_dir, pkg_path, version=version,
+                                        conda_args=conda_args)
+        print(f"  - build cache key {cache_key}")
+        with timed("cache"):
+            restored = (
+                not args.force
+                and restore_from_build_cache(cache_key, args.build_cache, build_dir)
+            )
+        if restored:
+            if timer is not None:
+                timer.status = "cached"
+            return
+
+    # the environment is passed to conda build explicitly so concurrent builds do not interfere
+    env = dict(os.environ)
+    if version is not None:
+        env["SKA_PKG_VERSION"] = version
+
+    if args.force:
+        remove_previous_builds(name, build_dir)
+
+    artifacts_before = get_artifacts(build_dir)
+    if args.in_process:
+        run_conda_build_api(pkg_path, build_dir, args, conda_args, version)
+    else:
+        run_conda_build_command(pkg_path, build_dir, args, conda_args, env, log_file=log_file)
+    store_new_artifacts(build_dir, artifacts_before, cache_key, args)
+
+
+def get_package_version(src_path, tag):
+    """
+    Get the SKA_PKG_VERSION of a package.
+
+    This is the version setuptools_scm gives to the package's repository (if it was cloned),
+    or the tag otherwise.
+    """
+    version = None
+    if src_path.exists():
+        try:
+            version = get_scm_version(git.Repo(src_path))
+            print(f"  - SKA_PKG_VERSION={version} (from setuptools_scm)")
+        except Exception as exc:
+            print(f"  - Could not get version from git: {exc}")
+    if version is None:
+        version = tag
         print(f'  - SKA_PKG_VERSION={version} (from tag)')
+    return version
+
 
-    os.environ['SKA_PKG_VERSION'] = version
+def remove_previous_builds(name, build_dir):
+    """
+    Remove cached builds of a package, so --force really builds it again.
+    """
+    for path in Path(build_dir).glob(f"*/.cache/*/{name}-*"):
+        print(f"Removing {path}")
+        path.unlink()
 
+    sys_prefix = Path(sys.prefix)
+    if (sys_prefix.parent).name == "envs":
+        # Building in a miniconda env, can find packages one dir up in pkgs
+        pkgs_dir = sys_prefix.parent.parent / "pkgs"
+        for path in pkgs_dir.glob(f"{name}-*"):
+            print(f'Removing {path}')
+            if path.is_dir():
+                shutil.rmtree(path)
+            else:
+                path.unlink()
+
+
+def run_conda_build_command(pkg_path, build_dir, args, conda_args, env, *, log_file=None):
+    """
+    Build a package running 'conda build' in a subprocess.
+
+    The output goes to log_file, or to stdout if log_file is None.
+    """
     cmd_list = ["conda", "build", str(pkg_path),
                 "--croot", str(build_dir),
                 "--old-build-string",
@@ -154,41 +422,790 @@ def build_package(name, args, src_dir, build_dir, conda_args=None):
     if not args.test:
         cmd_list.append("--no-test")
 
-    if args.force:
-        for path in Path(build_dir).glob(f'*/.cache/*/{name}-*'):
-            print(f'Removing {path}')
-            path.unlink()
-
-        sys_prefix = Path(sys.prefix)
-        if (sys_prefix.parent).name == 'envs':
-            # Building in a miniconda env, can find packages one dir up in pkgs
-            pkgs_dir = sys_prefix.parent.parent / 'pkgs'
-            for path in pkgs_dir.glob(f'{name}-*'):
-                print(f'Removing {path}')
-                if path.is_dir():
-                    shutil.rmtree(path)
-                else:
-                    path.unlink()
-
-    else:
+    if not args.force:
         cmd_list += ["--skip-existing"]
 
     cmd = ' '.join(cmd_list)
     print(f'  - {cmd}')
     print('-' * 80)
+    if log_file is None:
+        run_conda_build(cmd_list, env, sys.stdout)
+    else:
+        print(f"  - conda build output in {log_file}")
+        with open(log_file, "w") as fh:
+            run_conda_build(cmd_list, env, fh)
+
+
+def store_new_artifacts(build_dir, artifacts_before, cache_key, args):
+    """
+    Store the packages that were just built in the build cache (if there is one).
+    """
+    timer = get_timer()
+    with timed("cleanup"):
+        artifacts = get_artifacts(build_dir)
+        new_artifacts = [
+            path for path, mtime in artifacts.items() if artifacts_before.get(path) != mtime
+        ]
+        if timer is not None and not new_artifacts:
+            timer.status = "existing"
+    if cache_key is not None and new_artifacts:
+        with timed("cache"):
+            store_in_build_cache(cache_key, args.build_cache, new_artifacts)
+
+
+@contextlib.contextmanager
+def environ_var(name, value):
+    """
+    Set one environment variable within a block (if value is not None).
+    """
+    saved = os.environ.get(name)
+    if value is not None:
+        os.environ[name] = value
+    try:
+        yield
+    finally:
+        if saved is None:
+            os.environ.pop(name, None)
+        else:
+            os.environ[name] = saved
+
+
+def run_conda_build_api(pkg_path, build_dir, args, conda_args, version):
+    """
+    Build a package using conda_build.api.build within this process.
+
+    This is equivalent to the 'conda build' command used otherwise, but conda, conda-build and
+    the channel repodata are loaded only once per process and reused by all the builds. The
+    conda_build API changes process-wide state (os.environ, its config and index caches), so only
+    one build can run at a time.
+    """
+    import conda_build.api
+
+    channel_urls = [conda_args[i + 1] for i, arg in enumerate(conda_args[:-1]) if arg == "-c"]
+    print(f"  - conda_build.api.build({pkg_path}, croot={build_dir}, "
+          f"channel_urls={channel_urls})")
+    print('-' * 80)
+    phases = CondaBuildPhases(sys.stdout)
+    with environ_var("SKA_PKG_VERSION", version), contextlib.redirect_stdout(phases), phases:
+        conda_build.api.build(
+            str(pkg_path),
+            notest=not args.test,
+            variants={"python": [args.python], "numpy": [args.numpy], "perl": [args.perl]},
+            croot=str(build_dir),
+            anaconda_upload=False,
+            filename_hashing=False,  # same as --old-build-string
+            skip_existing=not args.force,
+            channel_urls=tuple(channel_urls),
+            override_channels="--override-channels" in conda_args,
+        )
+
+
+class CondaBuildPhases:
+    """
+    Time the render, build and test phases of conda build from its output.
+
+    This is a file-like object. The text written to it is copied to `output`, and the phases are
+    told apart by the "BUILD START" and "TEST START" lines. The last phase ends when the object is
+    closed (or at the end of a with block).
+    """
+
+    def __init__(self, output):
+        self.output = output
+        self.timer = get_timer()
+        self.phase = "render"
+        self.phase_start = time.perf_counter()
+        self._line = ""
+
+    def write(self, text):
+        self.output.write(text)
+        lines = (self._line + text).split("\n")
+        self._line = lines.pop()
+        for line in lines:
+            next_phase = (
+                "build" if line.startswith("BUILD START") and self.phase == "render"
+                else "test" if line.startswith("TEST START") and self.phase != "test"
+                else None
+            )
+            if next_phase is not None:
+                self._end_phase()
+                self.phase = next_phase
+        return len(text)
+
+    def flush(self):
+        self.output.flush()
+
+    def _end_phase(self):
+        if self.timer is not None:
+            self.timer.add(self.phase, time.perf_counter() - self.phase_start)
+        self.phase_start = time.perf_counter()
+
+    def close(self):
+        self.flush()
+        self._end_phase()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def run_conda_build(cmd_list, env, output):
+    """
+    Run conda build, timing its render, build and test phases (see `CondaBuildPhases`).
+
+    The conda build output is copied to `output`. The CPU time of the conda build process (and its
+    children) is recorded as a whole, where the platform allows it.
+    """
     is_windows = os.name == 'nt'  # Need shell below for Windows
-    subprocess.run(cmd_list, check=True, shell=is_windows).check_returncode()
+    timer = get_timer()
+    phases = CondaBuildPhases(output)
+    proc = subprocess.Popen(cmd_list, shell=is_windows, env=env, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT, text=True, errors="replace")
+    for line in proc.stdout:
+        phases.write(line)
+    phases.flush()
+
+    if hasattr(os, "wait4"):
+        _, status, rusage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        if timer is not None:
+            timer.conda_cpu += rusage.ru_utime + rusage.ru_stime
+    else:
+        proc.wait()
+    phases.close()
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd_list)
+
+
+class BuildTimer:
+    """
+    Wall and CPU time of the phases of a package build.
+
+    The CPU time of a phase is the CPU time of the thread running it. The CPU time of the conda
+    build process is recorded separately, in `conda_cpu`.
+    """
+
+    def __init__(self, pkg_name):
+        self.pkg_name = pkg_name
+        self.version = None
+        self.status = "built"
+        self.phases = {}
+        self.conda_cpu = 0.
+        self.start = time.time()
+
+    def add(self, phase, wall, cpu=0.):
+        times = self.phases.setdefault(phase, {"wall": 0., "cpu": 0.})
+        times["wall"] += wall
+        times["cpu"] += cpu
+
+    def record(self, args):
+        return {
+            "time": datetime.datetime.fromtimestamp(self.start).isoformat(timespec="seconds"),
+            "package": self.pkg_name,
+            "version": self.version,
+            "python": args.python,
+            "numpy": args.numpy,
+            "subdir": get_conda_subdir(),
+            "status": self.status,
+            "wall": round(time.time() - self.start, 3),
+            "cpu": round(sum(p["cpu"] for p in self.phases.values()) + self.conda_cpu, 3),
+            "conda_cpu": round(self.conda_cpu, 3),
+            "phases": {
+                phase: {k: round(v, 3) for k, v in times.items()}
+                for phase, times in self.phases.items()
+            },
+        }
+
+
+# the timer of the build running in the current thread
+_TIMER = threading.local()
+_TIMINGS_LOCK = threading.Lock()
+
+
+def get_timer():
+    return getattr(_TIMER, "timer", None)
+
+
+@contextlib.contextmanager
+def timed(phase):
+    """
+    Add the time spent in the block to the given phase of the current build (if any).
+    """
+    wall, cpu = time.perf_counter(), time.thread_time()
+    try:
+        yield
+    finally:
+        if (timer := get_timer()) is not None:
+            timer.add(phase, time.perf_counter() - wall, time.thread_time() - cpu)
+
+
+def get_timings_file(args):
+    return Path(args.timings) if args.timings else Path(args.build_root) / "build_timings.jsonl"
+
+
+@contextlib.contextmanager
+def package_timer(pkg_name, args):
+    """
+    Time the build of a package in the current thread and append it to the timings file.
+    """
+    timer = BuildTimer(pkg_name)
+    _TIMER.timer = timer
+    try:
+        yield timer
+    except BaseException:
+        timer.status = "failed"
+        raise
+    finally:
+        _TIMER.timer = None
+        timings_file = get_timings_file(args)
+        with _TIMINGS_LOCK:
+            timings_file.parent.mkdir(parents=True, exist_ok=True)
+            with open(timings_file, "a") as fh:
+                fh.write(json.dumps(timer.record(args)) + "\n")
+
+
+def read_timings(timings_file):
+    if not Path(timings_file).exists():
+        return []
+    with open(timings_file) as fh:
+        return [json.loads(line) for line in fh if line.strip()]
+
+
+def get_expected_durations(timings, python):
+    """
+    Wall time of the latest complete build of each package for a given python version.
+    """
+    durations = {}
+    for record in timings:
+        if record["python"] == python and record["status"] == "built":
+            durations[record["package"]] = record["wall"]
+    return durations
+
+
+def estimate_durations(metas, timings, python):
+    """
+    Expected build time of each package.
+
+    This is the time of the latest recorded build. Packages without recorded builds are assumed
+    to take as long as the slowest recorded package if they are compiled (they have a build.sh or
+    use a compiler), and the median time of recorded packages otherwise.
+    """
+    durations = get_expected_durations(timings, python)
+    known = sorted(durations.values())
+    default = statistics.median(known) if known else 60.
+    default_compiled = known[-1] if known else 600.
+    estimates = {}
+    for pkg_name in metas:
+        if pkg_name in durations:
+            estimates[pkg_name] = durations[pkg_name]
+        elif ((PKG_DEFS_PATH / pkg_name / "build.sh").exists()
+              or "compiler(" in (PKG_DEFS_PATH / pkg_name / "meta.yaml").read_text()):
+            estimates[pkg_name] = default_compiled
+        else:
+            estimates[pkg_name] = default
+    return estimates
+
+
+def get_priorities(graph, durations):
+    """
+    Scheduling priority of each package in a dependency graph.
+
+    The priority of a package is the expected time from the moment it starts to the end of the
+    build of all the packages that depend on it, directly or indirectly (i.e.: its duration plus
+    the largest priority of the packages that require it).
+    """
+    dependents = collections.defaultdict(set)
+    for pkg_name, deps in graph.items():
+        for dep in deps:
+            dependents[dep].add(pkg_name)
+
+    priorities = {}
+
+    def get_priority(pkg_name, visiting=()):
+        if pkg_name not in priorities:
+            priorities[pkg_name] = durations.get(pkg_name, 0.) + max(
+                [get_priority(d, visiting + (pkg_name,))
+                 for d in dependents[pkg_name] if d not in visiting],
+                default=0.
+            )
+        return priorities[pkg_name]
+
+    for pkg_name in graph:
+        get_priority(pkg_name)
+    return priorities
+
 
+def get_critical_path(graph, durations):
+    """
+    Longest path through the dependency graph, weighting each package by its duration.
+
+    :param graph: dict. The set of packages each package depends on.
+    :param durations: dict. Duration of each package (missing packages count as zero).
+    :return: tuple (path, total). The list of packages in build order and the total duration.
+    """
+    finish = {}
+    previous = {}
+
+    def get_finish(pkg_name, visiting=()):
+        if pkg_name not in finish:
+            deps = [d for d in graph.get(pkg_name, ()) if d not in visiting]
+            start = 0.
+            previous[pkg_name] = None
+            for dep in deps:
+                if get_finish(dep, visiting + (pkg_name,)) > start:
+                    start, previous[pkg_name] = finish[dep], dep
+            finish[pkg_name] = start + durations.get(pkg_name, 0.)
+        return finish[pkg_name]
+
+    if not graph:
+        return [], 0.
+    last = max(graph, key=get_finish)
+    path = [last]
+    while previous[path[-1]] is not None:
+        path.append(previous[path[-1]])
+    return path[::-1], finish[last]
+
+
+def print_report(pkg_names, args, n_rows=20):
+    """
+    Print the slowest packages, regressions and critical path from the build timings.
+    """
+    timings_file = get_timings_file(args)
+    timings = [r for r in read_timings(timings_file) if r["python"] == args.python]
+    print(f"Build timings from {timings_file} (python {args.python})")
+
+    history = collections.defaultdict(list)
+    for record in timings:
+        if record["status"] == "built":
+            history[record["package"]].append(record)
+    if not history:
+        print("No recorded builds")
+        return
+
+    phases = ["clone", "checkout", "version", "render", "build", "test", "cleanup", "cache"]
+    print()
+    print("Slowest packages (latest build, seconds)")
+    print(f'{"package":<24} {"version":<16} {"wall":>8} {"cpu":>8} '
+          + " ".join(f"{p:>8}" for p in phases))
+    latest = sorted((records[-1] for records in history.values()),
+                    key=lambda r: r["wall"], reverse=True)
+    for record in latest[:n_rows]:
+        phase_times = " ".join(
+            f'{record["phases"].get(p, {}).get("wall", 0.):8.1f}' for p in phases
+        )
+        print(f'{record["package"]:<24} {str(record["version"]):<16} {record["wall"]:8.1f} '
+              f'{record["cpu"]:8.1f} {phase_times}')
+
+    print()
+    print("Regressions (latest build vs median of previous builds)")
+    regressions = []
+    for pkg_name, records in history.items():
+        if len(records) < 2:
+            continue
+        reference = statistics.median(r["wall"] for r in records[:-1])
+        wall = records[-1]["wall"]
+        if wall > 1.25 * reference and wall - reference > 10:
+            regressions.append((pkg_name, reference, wall))
+    for pkg_name, reference, wall in sorted(regressions, key=lambda r: r[1] - r[2]):
+        print(f"{pkg_name:<24} {reference:8.1f} -> {wall:8.1f} ({wall / reference:.1f}x)")
+    if not regressions:
+        print("None")
+
+    metas = {pkg_name: read_meta(pkg_name)[1] for pkg_name in pkg_names}
+    graph = get_dependency_graph(metas)
+    durations = get_expected_durations(timings, args.python)
+    path, total = get_critical_path(graph, durations)
+    print()
+    print(f"Critical path: {total:.1f} seconds "
+          f"(sum of all packages: {sum(durations.get(p, 0.) for p in graph):.1f} seconds)")
+    for pkg_name in path:
+        print(f"  {pkg_name:<24} {durations.get(pkg_name, 0.):8.1f}")
+
+
+def get_artifacts(build_dir):
+    """
+    Conda packages in the channel subdirectories of a croot.
+
+    :return: dict. The modification time of each package file.
+    """
+    artifacts = {}
+    for path in Path(build_dir).glob("*/*"):
+        if (re.match(r"(noarch|[a-z]+-[a-z0-9]+)$", path.parent.name)
+                and re.search(r"\.(conda|tar\.bz2)$", path.name)):
+            artifacts[path] = path.stat().st_mtime_ns
+    return artifacts
+
+
+def get_build_cache_key(name, args, src_dir, pkg_path, *, version, conda_args):
+    """
+    Hash of everything that determines the result of building a package.
+
+    This includes the recipe directory (after overwriting ska3 versions), the package version,
+    the source commit, the build options, the channels and the platform. The local channel of the
+    packages built in this run (added with --jobs) is left out, since its path is not relevant.
+    """
+    sha = hashlib.sha256()
+
+    def update(label, value):
+        sha.update(f"{label}\0".encode())
+        sha.update(value if isinstance(value, bytes) else str(value).encode())
+        sha.update(b"\0")
+
+    # meta.yaml is rendered with SKA_PKG_VERSION and the (temporary) source directory, so the
+    # unrendered text plus the version is what identifies the rendered recipe.
+    for path in sorted(p for p in Path(pkg_path).rglob("*") if p.is_file()):
+        update(path.relative_to(pkg_path).as_posix(), path.read_bytes())
+    update("version", version)
+
+    src_path = Path(src_dir) / name
+    if (src_path / ".git").exists():
+        repo = git.Repo(src_path)
+        update("commit", repo.head.commit.hexsha)
+        update("dirty", repo.is_dirty(untracked_files=True))
+
+    for option in ("python", "numpy", "perl", "test"):
+        update(option, getattr(args, option))
+    build_channel = (Path(args.build_root) / "builds").absolute()
+    key_args = []
+    for i, arg in enumerate(conda_args):
+        if conda_args[i - 1:i] == ["-c"] and Path(arg).absolute() == build_channel:
+            key_args.pop()
+        else:
+            key_args.append(arg)
+    update("conda_args", " ".join(key_args))
+    update("subdir", get_conda_subdir())
+    return sha.hexdigest()
+
+
+def get_build_cache_path(cache_key, build_cache):
+    return Path(build_cache) / cache_key[:2] / cache_key
+
+
+def restore_from_build_cache(cache_key, build_cache, build_dir):
+    """
+    Copy (or hard-link) packages from the build cache into a croot and index it.
+
+    :return: bool. Whether the packages were found in the cache.
+    """
+    entry = get_build_cache_path(cache_key, build_cache)
+    if not entry.exists():
+        return False
+    for path in entry.glob("*/*"):
+        destination = Path(build_dir) / path.parent.name / path.name
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        if destination.exists():
+            destination.unlink()
+        try:
+            os.link(path, destination)
+        except OSError:
+            shutil.copy2(path, destination)
+        print(f"  - {path.name} from build cache")
+    index_channel(build_dir)
+    return True
+
+
+def store_in_build_cache(cache_key, build_cache, artifacts):
+    entry = get_build_cache_path(cache_key, build_cache)
+    if entry.exists():
+        return
+    entry.parent.mkdir(parents=True, exist_ok=True)
+    # copy into a temporary directory and then rename, so there are never partial entries
+    tmp_entry = Path(tempfile.mkdtemp(dir=entry.parent, prefix=f".{cache_key}-"))
+    for path in artifacts:
+        (tmp_entry / path.parent.name).mkdir(exist_ok=True)
+        shutil.copy2(path, tmp_entry / path.parent.name / path.name)
+    try:
+        tmp_entry.rename(entry)
+        print(f'  - stored {", ".join(p.name for p in artifacts)} in build cache')
+    except OSError:
+        # another build stored the same entry in the meantime
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+
+
+def read_meta(pkg_name):
+    """
+    Read the meta.yaml of a package in pkg_defs.
+
+    :param pkg_name: str
+    :return: tuple (meta_text, meta). The raw text and the parsed (stubbed) recipe.
+    """
+    meta_file = PKG_DEFS_PATH / pkg_name / "meta.yaml"
+    meta_text = meta_file.read_text()
+    # Stub out the jinja context variables and parse meta.yaml
+    meta = load_recipe(meta_file, jinja=True, context={"environ": os.environ})
+    return meta_text, meta
+
+
+def skip_package(pkg_name, meta, args):
+    if args.arch_specific and "noarch" in meta.get("build", {}):
+        print(f"Skipping noarch package {pkg_name}")
+        return True
+
+    if any(fnmatch(pkg_name, exclude) for exclude in args.excludes):
+        print(f"Skipping excluded package {pkg_name}")
+        return True
+
+    return False
+
+
+def get_requirement_names(meta):
+    """
+    Names of all packages in the build/host/run requirements of a parsed meta.yaml.
+    """
+    requirements = meta.get("requirements") or {}
+    names = set()
+    for section in ("build", "host", "run"):
+        for requirement in requirements.get(section) or []:
+            # rendered jinja macros can leave empty entries
+            if requirement and str(requirement).strip():
+                names.add(re.split(r"[\s=<>!~]", str(requirement).strip(), maxsplit=1)[0].lower())
+    return names
+
+
+def get_dependency_graph(metas):
+    """
+    Make the dependency graph of a set of packages.
+
+    Only requirements that are also in the given set of packages are included.
+
+    :param metas: dict. Parsed meta.yaml for each package directory in pkg_defs.
+    :return: dict. The set of package directories each package directory depends on.
+    """
+    # requirements refer to package names, which are not always the same as directory names
+    pkg_dirs = {meta["package"]["name"].lower(): pkg_name for pkg_name, meta in metas.items()}
+    graph = {}
+    for pkg_name, meta in metas.items():
+        graph[pkg_name] = {
+            pkg_dirs[name] for name in get_requirement_names(meta)
+            if name in pkg_dirs and pkg_dirs[name] != pkg_name
+        }
+    return graph
+
+
+def index_channel(channel_dir):
+    """
+    Create or update the repodata of a local conda channel.
+    """
+    channel_dir = Path(channel_dir)
+    (channel_dir / "noarch").mkdir(parents=True, exist_ok=True)
+    subprocess.run([sys.executable, "-m", "conda_index", str(channel_dir)],
+                   check=True, capture_output=True)
+
+
+def merge_croot(croot, build_dir):
+    """
+    Move the packages built in `croot` into the local channel at `build_dir`.
+
+    Only files in subdirectories of croot that are conda channel subdirs (i.e., that have a
+    repodata.json) are moved. The local channel is not re-indexed.
+
+    :return: list of Path. The merged packages.
+    """
+    merged = []
+    for subdir in Path(croot).glob("*"):
+        if not (subdir / "repodata.json").exists():
+            continue
+        for path in list(subdir.glob("*.conda")) + list(subdir.glob("*.tar.bz2")):
+            destination = Path(build_dir) / subdir.name
+            destination.mkdir(parents=True, exist_ok=True)
+            print(f"  - {path.name} -> {destination}")
+            shutil.move(str(path), str(destination / path.name))
+            merged.append(destination / path.name)
+    return merged
+
+
+def normalize_version(version):
+    try:
+        return str(Version(str(version)))
+    except InvalidVersion:
+        return str(version)
+
+
+def get_channel_index(channel_dirs):
+    """
+    Index the packages in local conda channels.
+
+    :param channel_dirs: list of Path
+    :return: dict. Lists of repodata records, keyed by (name, normalized version).
+    """
+    index = collections.defaultdict(list)
+    for channel_dir in channel_dirs:
+        for repodata_file in Path(channel_dir).glob("*/repodata.json"):
+            repodata = get_repodata(channel_dir, repodata_file.parent.name)
+            for key in ("packages", "packages.conda"):
+                for record in repodata.get(key, {}).values():
+                    index[(record["name"], normalize_version(record["version"]))].append(record)
+    return index
+
+
+def get_remote_tags(url):
+    """
+    Names of the tags in a remote repository (using git ls-remote, without cloning).
+    """
+    tags = set()
+    for line in git.cmd.Git().ls_remote("--tags", url).splitlines():
+        ref = line.split()[-1]
+        tags.add(re.sub(r"\^\{\}$", "", ref.replace("refs/tags/", "", 1)))
+    return tags
+
+
+def get_target_version(pkg_name, meta_text, meta, args):
+    """
+    Get the version a package would be built with, without cloning its repository.
+
+    For packages built from a repository, this is the version given by the tag that would be
+    checked out, which can only be determined cheaply if the tag is given explicitly (it is looked
+    up with git ls-remote) or if there is a git cache (where the tag with the most recent commit is
+    found). It returns None if the version can not be determined this way.
+    """
+    has_git = re.search(r"SKA_PKG_VERSION|GIT_DESCRIBE_TAG", meta_text)
+    if not has_git:
+        version = str(meta["package"].get("version") or "").strip()
+        if version and args.ska3_overwrite_version and re.match(r"ska3-\S+$", pkg_name):
+            skare3_old_version, skare3_new_version = args.ska3_overwrite_version.split(":")
+            if version == skare3_old_version:
+                version = skare3_new_version
+        return version or None
+
+    if args.repo_url:
+        # tags can come from two different remotes
+        return None
+
+    url, _ = get_repo_urls(args, meta)
+    if args.git_cache:
+        mirror = git.Repo(update_mirror(url, args.git_cache))
+        tag = args.tag if args.tag is not None else get_latest_tag(mirror).name
+        tags = {t.name for t in mirror.tags}
+    elif args.tag is not None:
+        tag = args.tag
+        tags = get_remote_tags(url)
+    else:
+        return None
+
+    if tag not in tags:
+        # a branch or commit
+        return None
+    try:
+        # this is what setuptools_scm gives when the repository is checked out at the tag
+        return str(Version(tag))
+    except InvalidVersion:
+        return None
+
+
+def is_built(meta, version, index, args):
+    """
+    Check whether the index has a package built from this recipe, version and build matrix.
+
+    This is conservative. When in doubt, the package is considered not built.
+    """
+    build = meta.get("build") or {}
+    requirements = get_requirement_names(meta)
+    host_requirements = get_requirement_names({"requirements": {
+        k: v for k, v in (meta.get("requirements") or {}).items() if k in ("build", "host")
+    }})
+    name = meta["package"]["name"].lower()
+    for record in index.get((name, normalize_version(version)), []):
+        if str(record.get("build_number", 0)) != str(build.get("number", 0)):
+            continue
+        if "noarch" in build:
+            return True
+        if record.get("subdir") != get_conda_subdir():
+            continue
+        if "python" in requirements and f'py{args.python.replace(".", "")}' not in record["build"]:
+            continue
+        if ("numpy" in host_requirements
+                and f'np{args.numpy.replace(".", "")}' not in record["build"]):
+            continue
+        return True
+    return False
+
+
+def plan_packages(pkg_names, args, build_dir):
+    """
+    Remove the packages that are already built from a list of packages to build.
+
+    This is done before cloning any repository or starting conda, by comparing the version each
+    package would be built with against the packages in the output directory and in any local
+    channel given with --channel. Packages whose version can not be determined cheaply are kept
+    (conda build --skip-existing will skip them later if they exist).
+    """
+    channel_dirs = [Path(build_dir)] + [Path(c) for c in args.channel if Path(c).is_dir()]
+    index = get_channel_index(channel_dirs)
+    if args.git_cache is None and args.tag is None:
+        # git ls-remote does not give commit dates, so the latest tag is not known without cloning
+        print("Warning: without --git-cache (or --tag), packages built from git can not be "
+              "checked before cloning. They will all be cloned, and conda build skips the ones "
+              "already built")
+
+    def check(pkg_name):
+        meta_text, meta = read_meta(pkg_name)
+        try:
+            version = get_target_version(pkg_name, meta_text, meta, args)
+        except Exception as exc:
+            print(f"Could not determine the version of {pkg_name}: {exc}")
+            return False
+        if version is not None and is_built(meta, version, index, args):
+            print(f"Skipping {pkg_name}=={version} (already built)")
+            return True
+        return False
+
+    # this is mostly waiting for git, so threads work fine
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        built = list(executor.map(check, pkg_names))
+    return [pkg_name for pkg_name, is_done in zip(pkg_names, built, strict=True) if not is_done]
+
+
+def build_single_package(pkg_name, args, src_dir, build_dir, conda_args=None, *, log_file=None):
+    with timed("render"):
+        meta_text, meta = read_meta(pkg_name)
+    has_git = re.search(r"SKA_PKG_VERSION|GIT_DESCRIBE_TAG", meta_text)
+
+    print("- Building package %s." % pkg_name)
+    tag = None
+    if has_git:
+        tag = clone_repo(pkg_name, args, src_dir, meta)
+    build_package(pkg_name, args, src_dir, build_dir, conda_args=conda_args, tag=tag,
+                  log_file=log_file)
+    print("")
+
+
+def get_requirements_closure(graph, pkg_name):
+    """
+    All packages a package requires in a dependency graph, directly or indirectly.
+    """
+    closure = set()
+    pending = list(graph.get(pkg_name, ()))
+    while pending:
+        dep = pending.pop()
+        if dep not in closure:
+            closure.add(dep)
+            pending.extend(graph.get(dep, ()))
+    return closure
+
+
+def write_summary(summary, args):
+    """
+    Print the summary of a build and write it to the --summary file (if given).
+    """
+    print()
+    print("*" * 80)
+    for key in ("built", "failed", "skipped", "excluded", "not_built"):
+        print(f'*** {key}: {", ".join(summary[key]) if summary[key] else "-"}')
+    print("*" * 80)
+    if args.summary:
+        with open(args.summary, "w") as fh:
+            json.dump(summary, fh, indent=2)
 
-# these are macros to be able to parse meta.yaml files which use them
-# clearly, these do not do anything useful, just allow parsing to proceed
-JINJA_MACROS = """
-{% macro compiler(arg) %}{% endmacro %}
-{% macro pin_compatible(arg) %}arg{% endmacro %}
-"""
 
 def build_list_packages(pkg_names, args, src_dir, build_dir, conda_args=None):
-    failures = []
+    """
+    Build packages one at a time, in the order given.
+
+    What happens when a package fails depends on args.on_failure (see the --on-failure option).
+    """
+    summary = {"built": [], "failed": [], "skipped": {}, "excluded": [], "not_built": []}
+    graph = None
     tstart = time.time()
 
     for idx, pkg_name in enumerate(pkg_names):
@@ -196,41 +1213,164 @@ def build_list_packages(pkg_names, args, src_dir, build_dir, conda_args=None):
         print('*' * 80)
         print(f'*** {pkg_name} (build start: {time.time() - tstart:.1f} secs)')
         print('*' * 80)
-        # Read package meta.yaml text
-        meta_file = PKG_DEFS_PATH / pkg_name / "meta.yaml"
-        meta_text = meta_file.read_text()
-        has_git = re.search(r'SKA_PKG_VERSION|GIT_DESCRIBE_TAG', meta_text)
-
-        # Stub out the jinja context variables and parse meta.yaml
-        meta = yaml.safe_load(jinja2.Template(JINJA_MACROS + meta_text).render(environ=os.environ))
-
-        if args.arch_specific and 'noarch' in meta.get('build', {}):
-            print(f'Skipping noarch package {pkg_name}')
+        _, meta = read_meta(pkg_name)
+        if skip_package(pkg_name, meta, args):
+            summary["excluded"].append(pkg_name)
             continue
 
-        if any(fnmatch(pkg_name, exclude) for exclude in args.excludes):
-            print(f'Skipping excluded package {pkg_name}')
-            continue
+        if graph is not None:
+            failed_requirements = get_requirements_closure(graph, pkg_name) & set(summary["failed"])
+            if failed_requirements:
+                print(f'Skipping {pkg_name}, it requires {", ".join(sorted(failed_requirements))}')
+                summary["skipped"][pkg_name] = sorted(failed_requirements)
+                continue
 
-        print("- Building package %s." % pkg_name)
         try:
-            if has_git:
-                clone_repo(pkg_name, args, src_dir, meta)
-            build_package(pkg_name, args, src_dir, build_dir, conda_args=conda_args)
-            print('')
+            with package_timer(pkg_name, args):
+                build_single_package(pkg_name, args, src_dir, build_dir, conda_args=conda_args)
+            summary["built"].append(pkg_name)
         except Exception:
+            summary["failed"].append(pkg_name)
+            if args.on_failure == "skip-dependents":
+                if graph is None:
+                    graph = get_dependency_graph({name: read_meta(name)[1] for name in pkg_names})
+                continue
+
             # If there's a failure, confirm before continuing (only if there are more packages)
-            stop = True
-            if idx < len(pkg_names) - 1:
+            stop = args.on_failure == "stop"
+            if args.on_failure == "ask" and idx < len(pkg_names) - 1:
                 print(f'{pkg_name} failed, continue anyway (y/n)?')
                 stop = not input().lower().strip().startswith('y')
-            if not stop:
-                failures.append(pkg_name)
-                continue
-            else:
+            if stop:
+                summary["not_built"] = list(pkg_names[idx + 1:])
+                write_summary(summary, args)
                 raise ValueError(f"{pkg_name} failed")
-    if len(failures):
-        raise ValueError("Packages {} failed".format(",".join(failures)))
+
+    write_summary(summary, args)
+    if summary["failed"]:
+        raise ValueError("Packages {} failed".format(",".join(summary["failed"])))
+
+
+def skip_dependents(pkg_name, graph, waiting, summary):
+    """
+    Remove the packages that require a failed package (directly or not) from the waiting ones.
+    """
+    for name in list(waiting):
+        if pkg_name in get_requirements_closure(graph, name):
+            print(f"*** Skipping {name}, it requires {pkg_name}")
+            summary["skipped"].setdefault(name, []).append(pkg_name)
+            del waiting[name]
+
+
+def read_build_metas(pkg_names, args, summary):
+    """
+    Read the meta.yaml of the packages to build, adding the ones skipped to summary['excluded'].
+    """
+    metas = {}
+    for pkg_name in pkg_names:
+        _, meta = read_meta(pkg_name)
+        if skip_package(pkg_name, meta, args):
+            summary["excluded"].append(pkg_name)
+        else:
+            metas[pkg_name] = meta
+    return metas
+
+
+def build_graph_job(pkg_name, args, src_dir, build_dir, conda_args, *, index_lock):
+    """
+    Build one package in its own croot, then merge it into build_dir and re-index build_dir.
+    """
+    croot = build_dir / "jobs" / pkg_name
+    with package_timer(pkg_name, args):
+        build_single_package(pkg_name, args, src_dir, croot, conda_args=conda_args,
+                             log_file=build_dir / "logs" / f"{pkg_name}.log")
+        with timed("cleanup"):
+            with index_lock:
+                merge_croot(croot, build_dir)
+                index_channel(build_dir)
+            shutil.rmtree(croot, ignore_errors=True)
+
+
+def build_graph_packages(pkg_names, args, src_dir, build_dir, conda_args=None):
+    """
+    Build packages concurrently, following the dependency graph given by their requirements.
+
+    A package is built as soon as all the packages it requires (among the ones being built) are
+    built. Each package is built in its own croot (build_dir/jobs/<pkg_name>), and the resulting
+    packages are moved into build_dir, which is then re-indexed and used as a channel by all
+    builds. The output of each build goes into build_dir/logs/<pkg_name>.log.
+
+    Ready packages are started in order of decreasing priority (see `get_priorities`), with at
+    most args.jobs builds running at any time.
+
+    If a build fails and args.on_failure is 'skip-dependents' or 'continue', the packages that
+    require it (directly or not) are skipped, and all others are still built. Otherwise, no more
+    builds are started. An exception is raised at the end if any build failed.
+    """
+    build_dir = Path(build_dir).absolute()
+    if conda_args is None:
+        conda_args = []
+    conda_args = conda_args + ["-c", str(build_dir)]
+
+    summary = {"built": [], "failed": [], "skipped": {}, "excluded": [], "not_built": []}
+    metas = read_build_metas(pkg_names, args, summary)
+    graph = get_dependency_graph(metas)
+    keep_going = args.on_failure in ("continue", "skip-dependents")
+
+    (build_dir / "logs").mkdir(parents=True, exist_ok=True)
+    index_channel(build_dir)
+    index_lock = threading.Lock()
+
+    # packages are started as soon as their requirements are built and a worker is free,
+    # the ones with the longest expected time to the end of the whole build go first
+    durations = estimate_durations(metas, read_timings(get_timings_file(args)), args.python)
+    priorities = get_priorities(graph, durations)
+    order = {pkg_name: idx for idx, pkg_name in enumerate(pkg_names)}
+
+    tstart = time.time()
+    waiting = {pkg_name: set(graph[pkg_name]) for pkg_name in pkg_names if pkg_name in graph}
+    running = {}
+    stop = False
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        while (waiting and not stop) or running:
+            ready = [] if stop else sorted(
+                (name for name, deps in waiting.items() if not deps),
+                key=lambda name: (-priorities[name], -durations[name], order[name])
+            )
+            for pkg_name in ready[:args.jobs - len(running)]:
+                del waiting[pkg_name]
+                print(f"*** {pkg_name} (build start: {time.time() - tstart:.1f} secs, "
+                      f"expected {durations[pkg_name]:.0f} secs)")
+                running[executor.submit(
+                    build_graph_job, pkg_name, args, src_dir, build_dir, conda_args,
+                    index_lock=index_lock
+                )] = pkg_name
+            if not running:
+                # nothing is running and nothing is ready, so the remaining requirements are
+                # circular
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                pkg_name = running.pop(future)
+                try:
+                    future.result()
+                    print(f"*** {pkg_name} done ({time.time() - tstart:.1f} secs)")
+                    summary["built"].append(pkg_name)
+                except Exception as exc:
+                    print(f"*** {pkg_name} failed ({time.time() - tstart:.1f} secs): {exc}")
+                    summary["failed"].append(pkg_name)
+                    stop = stop or not keep_going
+                    skip_dependents(pkg_name, graph, waiting, summary)
+                    continue
+                for deps in waiting.values():
+                    deps.discard(pkg_name)
+
+    summary["not_built"] = list(waiting)
+    write_summary(summary, args)
+    if summary["failed"]:
+        raise ValueError("Packages {} failed".format(",".join(summary["failed"])))
+    if waiting:
+        raise ValueError("Circular requirements in packages {}".format(",".join(waiting)))
 
 
 def overwrite_skare3_version(current_version, new_version, pkg_path):
@@ -274,6 +1414,18 @@ def overwrite_skare3_version(current_version, new_version, pkg_path):
             f.write(line)
 
 
+def get_package_names(args):
+    """
+    The packages to build: the ones given as arguments, the ones in --build-list, or all.
+    """
+    if args.packages:
+        return sorted(args.packages)
+    if args.build_list:
+        with open(args.build_list) as fh:
+            return [line.strip() for line in fh if not re.match(r"\s*#", line) and line.strip()]
+    return sorted([str(pth.name) for pth in PKG_DEFS_PATH.glob("*") if pth.is_dir()])
+
+
 def main():
     args = get_opt()
 
@@ -305,15 +1457,11 @@ def main():
             args.ska3_overwrite_version = \
                 f'{version_info["release"]}{version_info["label"]}:{version_info["version"]}'
 
-    if args.packages:
-        pkg_names = sorted(args.packages)
-    else:
-        if args.build_list:
-            with open(args.build_list) as fh:
-                pkg_names = [line.strip() for line in fh
-                             if not re.match(r'\s*#', line) and line.strip()]
-        else:
-            pkg_names = sorted([str(pth.name) for pth in PKG_DEFS_PATH.glob('*') if pth.is_dir()])
+    pkg_names = get_package_names(args)
+
+    if args.report:
+        print_report(pkg_names, args)
+        return
 
     print(f'Building packages {pkg_names}')
 
@@ -331,10 +1479,17 @@ def main():
         conda_args += ["-c", channel]
 
     build_dir = Path(args.build_root) / 'builds'
+    if not (args.force or args.no_plan):
+        pkg_names = plan_packages(pkg_names, args, build_dir)
+        print(f"Building packages {pkg_names}")
+
     with tempfile.TemporaryDirectory() as src_dir:
         print(f'Using temporary directory {src_dir} for cloning')
         os.environ["SKA_TOP_SRC_DIR"] = src_dir
-        build_list_packages(pkg_names, args, src_dir, build_dir, conda_args=conda_args)
+        if args.jobs > 1:
+            build_graph_packages(pkg_names, args, src_dir, build_dir, conda_args=conda_args)
+        else:
+            build_list_packages(pkg_names, args, src_dir, build_dir, conda_args=conda_args)
 
 
 if __name__ == '__main__':
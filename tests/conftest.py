@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# the modules being tested are scripts at the top of the repository
+sys.path.insert(0, str(Path(__file__).absolute().parents[1]))
@@ -0,0 +1,41 @@
+import pytest
+
+from combine_arch_meta import get_selector
+
+PLATFORMS = ["linux", "osx", "osx and arm64", "win"]
+
+
+@pytest.mark.parametrize(
+    "platforms, expected",
+    [
+        (PLATFORMS, ""),
+        (["linux", "osx"], "linux or osx"),
+        (["osx", "osx and arm64"], "osx"),
+        (["osx and arm64"], "arm64 and osx"),
+        (["linux", "osx and arm64", "win"], "arm64 or linux or win"),
+    ],
+)
+def test_platform_selectors(platforms, expected):
+    assert get_selector(set(platforms), PLATFORMS) == expected
+
+
+def test_same_dimension():
+    labels = ["linux and py==311", "linux and py==312", "win and py==312"]
+    assert get_selector({"linux and py==312", "win and py==312"}, labels) == "py==312"
+    assert get_selector({"linux and py==311", "linux and py==312"}, labels) == "linux"
+
+
+def test_subset_labels():
+    # "osx" can not be told apart from "osx and arm64" with these conditions, so the label is used
+    labels = ["linux", "osx", "osx and arm64"]
+    assert get_selector({"osx"}, labels) == "osx"
+    assert get_selector({"osx and arm64"}, labels) == "arm64 and osx"
+
+
+def test_mixed_dimensions():
+    # "py==312" says nothing about the platform, and "win" or "osx and arm64" say nothing about
+    # python, so no condition is known to be false in other environments
+    labels = ["osx and arm64", "py==312", "win"]
+    assert get_selector({"osx and arm64", "win"}, labels) == "osx and arm64 or win"
+    assert get_selector({"py==312"}, labels) == "py==312"
+    assert get_selector({"win"}, labels) == "win"
@@ -0,0 +1,100 @@
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import git
+import pytest
+
+import ska_builder
+
+pytest.importorskip("setuptools_scm")
+
+
+@pytest.fixture
+def repo(tmp_path, monkeypatch):
+    monkeypatch.setattr(ska_builder, "_SCM_VERSIONS", {})
+    repo = git.Repo.init(tmp_path / "pkg")
+    with repo.config_writer() as config:
+        config.set_value("user", "name", "Test")
+        config.set_value("user", "email", "test@example.com")
+    commit(repo, "setup.py", "")
+    return repo
+
+
+def commit(repo, filename, text):
+    path = Path(repo.working_tree_dir) / filename
+    path.write_text(text)
+    repo.index.add([filename])
+    repo.index.commit(f"change {filename}")
+
+
+def setuptools_scm_cli(repo):
+    # what the builder used to run
+    output = subprocess.check_output(
+        [sys.executable, "-m", "setuptools_scm"], cwd=repo.working_tree_dir, text=True
+    )
+    return output.split()[-1].strip()
+
+
+def test_at_tag(repo):
+    repo.create_tag("3.0")
+    assert ska_builder.get_scm_version(repo) == "3.0"
+
+
+def test_after_tag(repo):
+    repo.create_tag("3.0")
+    commit(repo, "a.py", "")
+    version = ska_builder.get_scm_version(repo)
+    assert ".dev1+g" in version
+    assert version == setuptools_scm_cli(repo)
+
+
+def test_after_post_tag(repo):
+    repo.create_tag("3.0.post1")
+    commit(repo, "a.py", "")
+    version = ska_builder.get_scm_version(repo)
+    assert version.startswith("3.0.post2.dev1+g")
+    assert version == setuptools_scm_cli(repo)
+
+
+def test_at_dev_tag(repo):
+    repo.create_tag("3.1.dev2")
+    assert ska_builder.get_scm_version(repo) == "3.1.dev2"
+    assert ska_builder.get_scm_version(repo) == setuptools_scm_cli(repo)
+
+
+def test_dirty(repo):
+    repo.create_tag("3.0")
+    assert ska_builder.get_scm_version(repo) == "3.0"
+    (Path(repo.working_tree_dir) / "setup.py").write_text("# changed")
+    date = time.strftime("%Y%m%d", time.gmtime())
+    # the clean version is cached, but dirty working trees are not
+    version = ska_builder.get_scm_version(repo)
+    assert version.endswith(f".d{date}")
+    assert version == setuptools_scm_cli(repo)
+
+
+def test_cached_by_commit(repo):
+    repo.create_tag("3.0")
+    assert ska_builder.get_scm_version(repo) == "3.0"
+    commit(repo, "a.py", "")
+    assert ska_builder.get_scm_version(repo) == setuptools_scm_cli(repo) != "3.0"
+
+
+def test_pyproject_settings(repo):
+    commit(
+        repo,
+        "pyproject.toml",
+        '[tool.setuptools_scm]\n'
+        'version_scheme = "post-release"\n'
+        'local_scheme = "no-local-version"\n'
+        'tag_regex = "^release-(?P<version>[0-9.]+)$"\n'
+        'write_to = "version.py"\n',
+    )
+    repo.create_tag("release-3.0")
+    commit(repo, "a.py", "")
+    assert ska_builder.get_scm_version(repo) == "3.0.post1"
+    # the version file is left to the package build
+    assert not (Path(repo.working_tree_dir) / "version.py").exists()
+    assert ska_builder.get_scm_version(repo) == setuptools_scm_cli(repo)